@@ -0,0 +1,628 @@
+# Python
+import os
+import json
+import time
+import shutil
+import uuid
+import sqlite3
+import threading
+from contextlib import contextmanager,nullcontext
+from typing import ContextManager,Dict,List,Optional,Tuple
+try:
+    import fcntl
+except ImportError:
+    # Windows: no advisory locks, running one process is up to the user
+    fcntl = None
+# Snapshots
+import snapshot
+from snapshot import LazyRows,Snapshot
+# Metrics
+from metrics import storage_bytes_read,storage_bytes_written,storage_json_parse
+
+STORAGE = os.environ.get("TWITTER_STORAGE", "json")
+SQLITE_FILE = os.environ.get("TWITTER_SQLITE_FILE", "twitter.db")
+FSYNC = os.environ.get("TWITTER_FSYNC", "0") == "1"
+# Seconds the changes of other processes are kept for them to catch up
+CHANGES_RETENTION = float(os.environ.get("TWITTER_CHANGES_RETENTION", "300"))
+
+# Log entries, shared by every backend:
+#
+#     {"op": "put", "record": {...}}
+#     {"op": "delete", "key": "..."}
+
+def apply(rows:Dict[str,dict], key:str, entry:dict):
+    if entry["op"] == "put":
+        rows[entry["record"][key]] = entry["record"]
+    elif entry["op"] == "delete":
+        rows.pop(entry["key"], None)
+
+class Backend:
+    """
+    Backend
+
+    Where a Table persists its rows. The table keeps every row in memory
+    and hands the backend the log entries of each committed batch
+    """
+    # Entries written since the last compaction
+    pending = 0
+    # Name of the table, for metrics
+    table = ""
+    # Whether other processes write to the same storage
+    shared = False
+
+    def load(self) -> Dict[str,dict]:
+        raise NotImplementedError
+
+    def read(self) -> Dict[str,dict]:
+        """
+        Every row, as currently stored
+        """
+        raise NotImplementedError
+
+    def loaded(self):
+        """
+        Called once the rows are loaded and indexed
+        """
+
+    def append(self, entries:List[dict]):
+        raise NotImplementedError
+
+    def transaction(self) -> ContextManager:
+        """
+        Holds off writes from other processes until the block ends, so a
+        batch can catch up with them and commit atomically
+        """
+        return nullcontext()
+
+    def changes(self) -> Optional[List[dict]]:
+        """
+        Log entries committed by other processes since the last call, or
+        None if they are gone and the rows have to be read again
+        """
+        return []
+
+    def version(self) -> Optional[Tuple[str,int]]:
+        """
+        (id of the storage, position of the rows in it), the same in every
+        process sharing the storage, for validators that hold across
+        workers. None if only one process uses it
+        """
+        return None
+
+    def applied(self):
+        """
+        Called once the rows read by read() or the entries returned by
+        changes() are applied, so version() moves to them only then
+        """
+
+    def restore(self, name:str, index, rows:Dict[str,dict]) -> bool:
+        """
+        Loads `index` from what compact() stored of it under `name`,
+        brought up to date with `rows`. False if nothing is stored, the
+        table rebuilds it then
+        """
+        return False
+
+    def compact(self, lock:threading.RLock, rows:Dict[str,dict], indexes:Optional[Dict[str,object]] = None):
+        """
+        Folds the pending entries into the long-term storage.
+        `lock` is the table lock, held by writers while they append.
+
+        Backends that can store `indexes` (by name) with the rows do, see
+        restore()
+        """
+
+    def close(self):
+        pass
+
+# JSON files
+
+class Log:
+    """
+    Log
+
+    Append-only JSONL file. Every create, update or delete on a table is
+    one line, so the cost of a write doesn't depend on the table size
+    """
+    def __init__(self, path:str, table:str, fsync:bool = FSYNC):
+        self.path = path
+        self.table = table
+        self.fsync = fsync
+        self.entries = 0
+        self.file = None
+
+    def open(self):
+        self.truncate_torn_tail()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def truncate_torn_tail(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, entries:List[dict]):
+        """
+        Writes a batch of entries with a single write (and fsync)
+        """
+        # json.dumps escapes non-ASCII, so characters are bytes
+        data = "".join(json.dumps(entry) + "\n" for entry in entries)
+        self.file.write(data)
+        self.file.flush()
+        storage_bytes_written.inc(self.table, amount=len(data))
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.entries += len(entries)
+
+    @staticmethod
+    def replay(path:str, table:str = ""):
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        storage_bytes_read.inc(table, amount=len(data))
+        entries = []
+        start = time.perf_counter()
+        for line in data.splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A torn last line from a crash mid-append
+                break
+        storage_json_parse.observe(time.perf_counter() - start, table)
+        yield from entries
+
+class JSONBackend(Backend):
+    """
+    JSONBackend
+
+    The json file is a snapshot: writes are appended to <file>.log and
+    compact() folds the log back into the snapshot.
+
+    Only one process may use the files: load() takes an exclusive lock on
+    <file>.lock and fails if another process holds it.
+    """
+    def __init__(self, path:str, key:str, table:str = ""):
+        self.path = path
+        self.key = key
+        self.table = table or os.path.basename(path)
+        self.log = Log(path + ".log", self.table)
+        self.lock_file = None
+
+    @property
+    def pending(self) -> int:
+        return self.log.entries
+
+    def load(self) -> Dict[str,dict]:
+        self.acquire()
+        rows = self.read()
+        self.log.open()
+        return rows
+
+    def acquire(self):
+        if fcntl is None:
+            return
+        self.lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise RuntimeError(
+                f"{self.path} is in use by another process. "
+                "Use TWITTER_STORAGE=sqlite to run several workers"
+            )
+
+    def read(self) -> Dict[str,dict]:
+        """
+        Snapshot plus log, without opening the log for writing
+        """
+        rows = self.read_snapshot()
+        # A log left behind by an interrupted compaction comes first
+        old = self.log.path + ".old"
+        for path in (old, self.log.path):
+            for entry in Log.replay(path, self.table):
+                apply(rows, self.key, entry)
+                self.log.entries += 1
+        if os.path.exists(old):
+            self.write_snapshot(self.copy(rows))
+            os.remove(old)
+        return rows
+
+    def read_snapshot(self) -> Dict[str,dict]:
+        rows = {}
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+            storage_bytes_read.inc(self.table, amount=len(data))
+            start = time.perf_counter()
+            records = json.loads(data or b"[]")
+            storage_json_parse.observe(time.perf_counter() - start, self.table)
+            for record in records:
+                # The first record wins, as the old linear scans did
+                rows.setdefault(record[self.key], record)
+        return rows
+
+    def append(self, entries:List[dict]):
+        self.log.append(entries)
+
+    def compact(self, lock:threading.RLock, rows:Dict[str,dict], indexes:Optional[Dict[str,object]] = None):
+        """
+        Writes the snapshot and starts a new log.
+
+        The log is rotated under the lock, the snapshot is written outside
+        of it so writers are only blocked while copying the rows.
+        """
+        with lock:
+            if self.log.entries == 0:
+                return
+            copy = self.copy(rows)
+            rotated = self.rotate()
+        try:
+            self.write_snapshot(copy)
+        except Exception:
+            self.failed(lock, rotated)
+            raise
+        os.remove(self.log.path + ".old")
+
+    def rotate(self) -> int:
+        """
+        Moves the log to <log>.old and starts a new one, under the table
+        lock. Returns the number of entries moved.
+
+        A .old left by a failed compaction has entries the snapshot
+        doesn't, so the log is added to it instead of replacing it
+        """
+        old = self.log.path + ".old"
+        rotated = self.log.entries
+        self.log.close()
+        if os.path.exists(old):
+            with open(self.log.path, "rb") as source, open(old, "ab") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(self.log.path)
+        else:
+            os.replace(self.log.path, old)
+        self.log.entries = 0
+        self.log.open()
+        return rotated
+
+    def failed(self, lock:threading.RLock, rotated:int):
+        """
+        The snapshot wasn't written: the rotated entries are still pending,
+        so the next compaction is tried as soon as they are due
+        """
+        with lock:
+            self.log.entries += rotated
+
+    def copy(self, rows:Dict[str,dict]) -> Dict[str,dict]:
+        """
+        The rows as they are now, for write_snapshot(), taken under the lock
+        """
+        return rows.copy()
+
+    def write_snapshot(self, rows:Dict[str,dict]):
+        tmp = self.path + ".tmp"
+        # Rows kept in columns are read-only mappings
+        data = json.dumps(list(rows.values()), default=dict)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+        storage_bytes_written.inc(self.table, amount=len(data))
+
+    def close(self):
+        self.log.close()
+        if self.lock_file is not None:
+            # Closing the file releases the lock
+            self.lock_file.close()
+            self.lock_file = None
+
+class BinaryBackend(JSONBackend):
+    """
+    BinaryBackend
+
+    JSONBackend with a binary snapshot (<name>.bin, see snapshot.py)
+    instead of the json file. Starting up maps the snapshot and replays
+    the log, records are only decoded when read, so the time to start
+    and the memory used depend on what is read rather than on the size
+    of the table.
+
+    Compaction stores the indexes given to it in the snapshot, and
+    restore() loads them back instead of rebuilding them from every
+    record. A snapshot without them (seeded, or from an older version)
+    is written again on the next compaction even if nothing changed.
+
+    A missing snapshot is seeded from the json file at `seed`, so
+    switching TWITTER_STORAGE keeps the existing data.
+    """
+    def __init__(self, path:str, key:str, table:str = ""):
+        super().__init__(os.path.splitext(path)[0] + ".bin", key, table or os.path.basename(path))
+        self.seed = path
+        self.snapshot: Optional[Snapshot] = None
+
+    def read_snapshot(self) -> LazyRows:
+        if not os.path.exists(self.path):
+            rows = {}
+            if os.path.exists(self.seed):
+                rows = JSONBackend(self.seed, self.key, self.table).read()
+            self.write_snapshot(rows)
+        self.snapshot = Snapshot(self.path, self.key)
+        self.snapshot.cache_columns()
+        return LazyRows(self.snapshot)
+
+    def loaded(self):
+        self.snapshot.cache_columns(False)
+
+    def restore(self, name:str, index, rows:LazyRows) -> bool:
+        snapshot = self.snapshot
+        if not isinstance(rows, LazyRows) or rows.snapshot is not snapshot:
+            return False
+        stored = snapshot.index(name)
+        # The index checks a few entries against the snapshot rows
+        if stored is None or not index.restore(LazyRows(snapshot, memo=0), *stored):
+            return False
+        # Then the writes replayed from the log
+        for key in rows.deleted:
+            index.remove(key)
+        for key, record in rows.overlay.items():
+            index.add(key, record)
+        return True
+
+    def compact(self, lock:threading.RLock, rows:LazyRows, indexes:Optional[Dict[str,object]] = None):
+        """
+        Writes the snapshot, starts a new log, then moves the rows onto
+        the new snapshot so the records written meanwhile are the only
+        ones left in memory.
+
+        The indexes are dumped under the lock with the rows, so the ones
+        stored match the records of the snapshot
+        """
+        indexes = indexes or {}
+        with lock:
+            if self.log.entries == 0 and all(name in self.snapshot.indexes for name in indexes):
+                return
+            written = rows.copy()
+            dumps = {name: index.dump() for name, index in indexes.items()}
+            rotated = self.rotate()
+        try:
+            self.write_snapshot(written, dumps)
+        except Exception:
+            self.failed(lock, rotated)
+            raise
+        with lock:
+            self.snapshot = Snapshot(self.path, self.key)
+            rows.rebase(self.snapshot, written)
+        os.remove(self.log.path + ".old")
+
+    def write_snapshot(self, rows:Dict[str,dict], indexes:Optional[Dict[str,tuple]] = None):
+        if isinstance(rows, LazyRows):
+            # Records from the old snapshot fit its schema already
+            schema = snapshot.infer_schema(rows.overlay.values(), rows.snapshot.schema)
+            records = rows.records()
+        else:
+            schema = snapshot.infer_schema(rows.values())
+            records = (rows[key] for key in sorted(rows))
+        if self.key not in dict(schema):
+            schema.append((self.key, snapshot.STR))
+        snapshot.write(self.path, records, self.key, schema, indexes)
+        storage_bytes_written.inc(self.table, amount=os.path.getsize(self.path))
+
+# SQLite
+
+class SQLiteBackend(Backend):
+    """
+    SQLiteBackend
+
+    One SQLite table per Table, (key TEXT PRIMARY KEY, record TEXT) in WAL
+    mode. Each batch is one transaction of prepared statements.
+
+    Several processes can share the database. Every batch is also written
+    to <table>_changes, a feed the other processes replay to catch up, and
+    transaction() takes the database write lock so batches from different
+    processes are applied one after the other.
+
+    The sequence number of the last change of the feed in the rows is
+    their version(), with an id stored in the database (in case it is
+    made again and the numbers start over).
+
+    A new table is seeded from the json snapshot at `seed`, so switching
+    TWITTER_STORAGE keeps the existing data.
+    """
+    shared = True
+
+    def __init__(self, path:str, table:str, key:str, seed:str = None):
+        self.path = path
+        self.table = table
+        self.feed = table + "_changes"
+        self.key = key
+        self.seed = seed
+        self.connection = None
+        self.created = False
+        self.lock = threading.RLock()
+        self.depth = 0
+        # Identifies the writes of this process in the feed
+        self.origin = uuid.uuid4().hex
+        # Last change of the feed read, and the one the rows are at
+        self.last = 0
+        self.position = 0
+        # First and last change written by the open transaction
+        self.written: Optional[Tuple[int,int]] = None
+        self.epoch = ""
+        self.put_sql = f"INSERT OR REPLACE INTO {table} (key, record) VALUES (?, ?)"
+        self.delete_sql = f"DELETE FROM {table} WHERE key = ?"
+        self.feed_sql = f"INSERT INTO {self.feed} (origin, key, record, created) VALUES (?, ?, ?, ?)"
+
+    def connect(self) -> sqlite3.Connection:
+        # Wait for other processes holding the write lock instead of failing
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=" + ("FULL" if FSYNC else "NORMAL"))
+        return connection
+
+    def create(self):
+        self.created = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (self.table,)
+        ).fetchone() is None
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, record TEXT NOT NULL)"
+        )
+        # A NULL record is a delete
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.feed} ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, "
+            "key TEXT NOT NULL, record TEXT, created REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.execute(
+            "INSERT OR IGNORE INTO meta (name, value) VALUES ('epoch', ?)", (uuid.uuid4().hex[:8],)
+        )
+        self.epoch = self.connection.execute("SELECT value FROM meta WHERE name = 'epoch'").fetchone()[0]
+
+    @contextmanager
+    def transaction(self, immediate:bool = True):
+        """
+        IMMEDIATE takes the write lock up front: a process that started
+        later waits here instead of failing at its first write
+        """
+        with self.lock:
+            if self.depth:
+                self.depth += 1
+                try:
+                    yield
+                finally:
+                    self.depth -= 1
+                return
+            self.connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            self.depth = 1
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            else:
+                self.connection.execute("COMMIT")
+                if self.written is not None and self.written[0] == self.last + 1:
+                    # Written right after the changes already read (the
+                    # Writer catches up first), so the rows are at its
+                    # last one
+                    self.last = self.position = self.written[1]
+            finally:
+                self.depth = 0
+                self.written = None
+
+    def load(self) -> Dict[str,dict]:
+        self.connection = self.connect()
+        # Under the write lock, so workers starting together seed only once
+        with self.transaction():
+            self.create()
+            if self.created and self.seed and os.path.exists(self.seed):
+                rows = JSONBackend(self.seed, self.key, self.table).read()
+                self.write([{"op": "put", "record": record} for record in rows.values()], feed=False)
+                return rows
+            return self.read()
+
+    def read(self) -> Dict[str,dict]:
+        with self.transaction(immediate=False):
+            self.last = self.connection.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {self.feed}").fetchone()[0]
+            records = [record for record, in self.connection.execute(f"SELECT record FROM {self.table}")]
+        storage_bytes_read.inc(self.table, amount=sum(map(len, records)))
+        start = time.perf_counter()
+        rows = {}
+        for record in map(json.loads, records):
+            rows[record[self.key]] = record
+        storage_json_parse.observe(time.perf_counter() - start, self.table)
+        return rows
+
+    def append(self, entries:List[dict]):
+        self.write(entries)
+
+    def write(self, entries:List[dict], feed:bool = True):
+        with self.transaction():
+            cursor = self.connection.cursor()
+            created = time.time()
+            written = 0
+            for entry in entries:
+                if entry["op"] == "put":
+                    record = entry["record"]
+                    key = record[self.key]
+                    data = json.dumps(record)
+                    written += len(data)
+                    cursor.execute(self.put_sql, (key, data))
+                elif entry["op"] == "delete":
+                    key, data = entry["key"], None
+                    cursor.execute(self.delete_sql, (key,))
+                else:
+                    continue
+                if feed:
+                    cursor.execute(self.feed_sql, (self.origin, key, data, created))
+                    seq = cursor.lastrowid
+                    self.written = (self.written[0] if self.written else seq, seq)
+            self.pending += len(entries)
+            storage_bytes_written.inc(self.table, amount=written * (2 if feed else 1))
+
+    def changes(self) -> Optional[List[dict]]:
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT seq, origin, key, record FROM {self.feed} WHERE seq > ? ORDER BY seq", (self.last,)
+            ).fetchall()
+            if not rows:
+                return []
+            # Sequence numbers have no gaps, unless the ones we missed were pruned
+            if rows[0][0] != self.last + 1:
+                return None
+            self.last = rows[-1][0]
+        entries = []
+        read = 0
+        for _, origin, key, record in rows:
+            if origin == self.origin:
+                continue
+            if record is None:
+                entries.append({"op": "delete", "key": key})
+            else:
+                read += len(record)
+                entries.append({"op": "put", "record": json.loads(record)})
+        storage_bytes_read.inc(self.table, amount=read)
+        return entries
+
+    def version(self) -> Optional[Tuple[str,int]]:
+        return self.epoch, self.position
+
+    def applied(self):
+        self.position = self.last
+
+    def compact(self, lock:threading.RLock, rows:Dict[str,dict], indexes:Optional[Dict[str,object]] = None):
+        with self.lock:
+            if self.pending == 0:
+                return
+            # The newest change is kept so the feed never looks pruned to a
+            # process that is up to date
+            self.connection.execute(
+                f"DELETE FROM {self.feed} WHERE created < ? AND seq < (SELECT MAX(seq) FROM {self.feed})",
+                (time.time() - CHANGES_RETENTION,)
+            )
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.pending = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+def make_backend(path:str, table:str, key:str, storage:str = STORAGE) -> Backend:
+    """
+    Backend for a table, picked by TWITTER_STORAGE ("json", "binary" or
+    "sqlite"). `path` is the json file of the table
+    """
+    if storage == "json":
+        return JSONBackend(path, key, table)
+    if storage == "binary":
+        return BinaryBackend(path, key, table)
+    if storage == "sqlite":
+        return SQLiteBackend(SQLITE_FILE, table, key, seed=path)
+    raise ValueError(f"Unknown storage backend {storage}")
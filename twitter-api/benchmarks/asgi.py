@@ -0,0 +1,119 @@
+"""
+In-process ASGI client
+
+Calls the app directly on the running event loop, without sockets or the
+TestClient thread, so many requests can be in flight at once and the
+timings only measure the app.
+"""
+# Python
+import asyncio
+import json
+from typing import Dict,List,Optional,Tuple
+from urllib.parse import urlencode
+
+class ASGIClient:
+    def __init__(self, app):
+        self.app = app
+        self.lifespan = None
+        self.lifespan_queue: asyncio.Queue = None
+
+    async def __aenter__(self) -> "ASGIClient":
+        await self.startup()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.shutdown()
+
+    async def startup(self):
+        self.lifespan_queue = asyncio.Queue()
+        started = asyncio.get_running_loop().create_future()
+        self.stopped = asyncio.get_running_loop().create_future()
+
+        async def send(message):
+            if message["type"] == "lifespan.startup.complete":
+                started.set_result(None)
+            elif message["type"] == "lifespan.startup.failed":
+                started.set_exception(RuntimeError(message.get("message")))
+            elif message["type"].startswith("lifespan.shutdown"):
+                self.stopped.set_result(None)
+
+        scope = {"type": "lifespan", "asgi": {"version": "3.0"}}
+        self.lifespan = asyncio.create_task(self.app(scope, self.lifespan_queue.get, send))
+        await self.lifespan_queue.put({"type": "lifespan.startup"})
+        await started
+
+    async def shutdown(self):
+        await self.lifespan_queue.put({"type": "lifespan.shutdown"})
+        await self.stopped
+        await self.lifespan
+
+    async def request(
+        self,
+        method:str,
+        path:str,
+        params:Optional[dict] = None,
+        headers:Optional[Dict[str,str]] = None,
+        json_body = None,
+        form:Optional[dict] = None
+    ) -> Tuple[int,Dict[str,str],bytes]:
+        """
+        Returns the status, headers and whole body of the response
+        """
+        body = b""
+        raw_headers: List[Tuple[bytes,bytes]] = [(b"host", b"bench")]
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            raw_headers.append((b"content-type", b"application/json"))
+        elif form is not None:
+            body = urlencode(form).encode()
+            raw_headers.append((b"content-type", b"application/x-www-form-urlencoded"))
+        raw_headers.append((b"content-length", str(len(body)).encode()))
+        for name, value in (headers or {}).items():
+            raw_headers.append((name.lower().encode(), value.encode()))
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": urlencode(params or {}, doseq=True).encode(),
+            "headers": raw_headers,
+            "server": ("bench", 80),
+            "client": ("127.0.0.1", 50000)
+        }
+        # Streaming responses listen for a disconnect while they send, so it
+        # only arrives once the response is complete
+        done = asyncio.Event()
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        status = 0
+        response_headers = {}
+        chunks = []
+
+        async def send(message):
+            nonlocal status, response_headers
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_headers = {
+                    name.decode().lower(): value.decode()
+                    for name, value in message.get("headers", [])
+                }
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    done.set()
+
+        await self.app(scope, receive, send)
+        done.set()
+        return status, response_headers, b"".join(chunks)
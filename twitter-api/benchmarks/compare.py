@@ -0,0 +1,46 @@
+"""
+Compare two load test results
+
+Prints the change in throughput and p99 latency per route, and exits
+with status 1 if any route regressed by more than --threshold percent.
+
+    python -m benchmarks.compare before.json after.json
+"""
+# Python
+import sys
+import json
+import argparse
+
+def change(before:float, after:float) -> float:
+    return (after - before) / before * 100 if before else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    args = parser.parse_args()
+
+    with open(args.before, encoding="utf-8") as f:
+        before = json.load(f)["routes"]
+    with open(args.after, encoding="utf-8") as f:
+        after = json.load(f)["routes"]
+
+    regressions = 0
+    print(f"{'route':50} {'req/s':>10} {'change':>8} {'p99 ms':>10} {'change':>8}")
+    for route, result in after.items():
+        old = before.get(route)
+        if old is None or "throughput" not in old or "throughput" not in result:
+            continue
+        throughput = change(old["throughput"], result["throughput"])
+        p99 = change(old["p99_ms"], result["p99_ms"])
+        regressed = throughput < -args.threshold or p99 > args.threshold
+        regressions += regressed
+        print(
+            f"{route:50} {result['throughput']:10.1f} {throughput:+7.1f}%"
+            f" {result['p99_ms']:10.2f} {p99:+7.1f}%" + ("  REGRESSION" if regressed else "")
+        )
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Dataset generator
+
+Writes user.json, tweets.json and follows.json in the format the app
+stores them, with realistic shapes: a few prolific authors, a long tail
+of quiet ones, followers skewed towards popular users and Spanish
+content.
+
+    python -m benchmarks.dataset --users 10000 --tweets 100000 --output data/
+"""
+# Python
+import os
+import json
+import random
+import argparse
+import itertools
+from uuid import UUID
+from dataclasses import dataclass,field
+from datetime import datetime,timedelta
+from typing import List
+
+FIRST_NAMES = ["Erick", "Ana", "Luis", "María", "José", "Lucía", "Carlos", "Sofía", "Jorge", "Valentina"]
+LAST_NAMES = ["Escobar", "García", "Martínez", "López", "Hernández", "González", "Pérez", "Sánchez"]
+WORDS = (
+    "hola mundo tweet fastapi python verano playa canción música fútbol partido gol "
+    "noticias lluvia sol café comida viaje ciudad película libro gato perro trabajo "
+    "código servidor base datos rápido lento mañana tarde noche hoy ayer siempre nunca"
+).split()
+START = datetime(2022, 1, 1)
+
+@dataclass
+class Dataset:
+    """
+    Ids of what was generated, for the benchmarks to pick from
+    """
+    directory: str
+    user_ids: List[str] = field(default_factory=list)
+    emails: List[str] = field(default_factory=list)
+    tweet_ids: List[str] = field(default_factory=list)
+    password: str = "password"
+
+def uuid(rng:random.Random) -> str:
+    return str(UUID(int=rng.getrandbits(128), version=4))
+
+def generate(directory:str, users:int, tweets:int, follows_per_user:int = 20, seed:int = 42) -> Dataset:
+    """
+    Writes the dataset to `directory` and returns its ids.
+
+    Hashing one password per user would take hours at 1M users, so every
+    user shares the scrypt hash of Dataset.password
+    """
+    # Import here so TWITTER_* settings can be changed before the app loads
+    from passwords import hash_password
+
+    rng = random.Random(seed)
+    dataset = Dataset(directory)
+    os.makedirs(directory, exist_ok=True)
+    password_hash = hash_password(dataset.password)
+
+    user_records = []
+    for i in range(users):
+        user_id = uuid(rng)
+        email = f"user{i}@example.com"
+        dataset.user_ids.append(user_id)
+        dataset.emails.append(email)
+        user_records.append({
+            "user_id": user_id,
+            "email": email,
+            "password": password_hash,
+            "first_name": rng.choice(FIRST_NAMES),
+            "last_name": rng.choice(LAST_NAMES),
+            "birth_date": str((START - timedelta(days=rng.randint(6000, 25000))).date())
+        })
+
+    # Zipf-like popularity: user i is picked with weight 1 / (i + 1)
+    weights = list(itertools.accumulate(1 / (i + 1) for i in range(users)))
+    span = 365 * 24 * 3600
+    tweet_records = []
+    authors = rng.choices(dataset.user_ids, cum_weights=weights, k=tweets)
+    for author in authors:
+        tweet_id = uuid(rng)
+        dataset.tweet_ids.append(tweet_id)
+        tweet_records.append({
+            "tweet_id": tweet_id,
+            "content": " ".join(rng.choices(WORDS, k=rng.randint(3, 20)))[:256],
+            "created_at": str(START + timedelta(seconds=rng.randrange(span), microseconds=rng.randrange(10 ** 6))),
+            "updated_at": None,
+            "author_id": author
+        })
+
+    follow_records = {}
+    for follower in dataset.user_ids:
+        for followee in rng.choices(dataset.user_ids, cum_weights=weights, k=min(follows_per_user, users - 1)):
+            if followee == follower:
+                continue
+            key = f"{follower}:{followee}"
+            follow_records[key] = {
+                "follow_id": key,
+                "follower_id": follower,
+                "followee_id": followee,
+                "created_at": str(START)
+            }
+
+    for name, records in (
+        ("user.json", user_records),
+        ("tweets.json", tweet_records),
+        ("follows.json", list(follow_records.values()))
+    ):
+        with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+            f.write(json.dumps(records))
+    return dataset
+
+def use(directory:str):
+    """
+    Points the app at the dataset in `directory`. Call before importing main
+    """
+    os.environ["TWITTER_USERS_FILE"] = os.path.join(directory, "user.json")
+    os.environ["TWITTER_TWEETS_FILE"] = os.path.join(directory, "tweets.json")
+    os.environ["TWITTER_FOLLOWS_FILE"] = os.path.join(directory, "follows.json")
+    os.environ["TWITTER_SQLITE_FILE"] = os.path.join(directory, "twitter.db")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--tweets", type=int, default=10_000)
+    parser.add_argument("--follows", type=int, default=20, help="follows per user")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="data")
+    args = parser.parse_args()
+    generate(args.output, args.users, args.tweets, args.follows, args.seed)
+    print(f"{args.users} users and {args.tweets} tweets written to {args.output}")
+
+if __name__ == "__main__":
+    main()
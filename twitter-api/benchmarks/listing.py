@@ -0,0 +1,65 @@
+"""
+Listing benchmark
+
+Time to serialize one page of GET / (home) with the pre-serialized
+cache, against the Pydantic round-trip FastAPI does with
+response_model=List[Tweets], plus end-to-end requests per second.
+
+    python -m benchmarks.listing --tweets 100000 --limit 200
+"""
+# Python
+import time
+import argparse
+import tempfile
+from typing import List
+
+from benchmarks.dataset import generate,use
+
+def timeit(function, rounds:int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - start) / rounds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--tweets", type=int, default=100_000)
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="twitter-bench-")
+    generate(directory, args.users, args.tweets, follows_per_user=0)
+    use(directory)
+
+    from pydantic import parse_obj_as
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from fastapi.testclient import TestClient
+    import main as app_module
+
+    with TestClient(app_module.app) as client:
+        repository = app_module.repository
+        tweets, _ = repository.tweets.page(repository.tweets_by_date, args.limit, descending=True)
+
+        def pydantic_round_trip():
+            joined = [repository.join(tweet) for tweet in tweets]
+            models = parse_obj_as(List[app_module.Tweets], joined)
+            JSONResponse(jsonable_encoder(models))
+
+        def cached():
+            app_module.json_list(map(app_module.tweet_json, tweets))
+
+        cached()
+        pydantic = timeit(pydantic_round_trip, args.rounds)
+        fast = timeit(cached, args.rounds)
+        print(f"tweets: {args.tweets}, page: {args.limit}")
+        print(f"pydantic round-trip: {pydantic * 1e3:8.2f} ms/page")
+        print(f"pre-serialized:      {fast * 1e3:8.2f} ms/page ({pydantic / fast:.0f}x)")
+
+        elapsed = timeit(lambda: client.get("/", params={"limit": args.limit}), args.rounds)
+        print(f"GET /?limit={args.limit}: {1 / elapsed:8.1f} requests/s")
+
+if __name__ == "__main__":
+    main()
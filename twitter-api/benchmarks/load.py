@@ -0,0 +1,339 @@
+"""
+Load test
+
+Generates a dataset, then drives every endpoint in process through the
+ASGI app with --concurrency requests in flight, and reports throughput
+and p50/p95/p99 latency per route. Results are written as json so two
+runs can be compared with benchmarks.compare.
+
+    python -m benchmarks.load --users 10000 --tweets 1000000 --requests 2000
+
+Endpoints that hash a password (signup, login, user updates) are run
+with a tenth of the requests, scrypt makes them ~1000x slower than the
+rest.
+"""
+# Python
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from uuid import uuid4
+from datetime import datetime,timedelta
+from dataclasses import dataclass,field
+from typing import Callable,Dict,List
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+from benchmarks.asgi import ASGIClient
+from benchmarks.dataset import START,Dataset,WORDS,generate,use
+
+@dataclass
+class Context:
+    """
+    State shared by the scenarios: what was generated and what the
+    write scenarios created, for the delete scenarios to remove
+    """
+    dataset: Dataset
+    rng: random.Random
+    users: Dict[str,dict] = field(default_factory=dict)
+    tweets: List[str] = field(default_factory=list)
+    signed_up: List[str] = field(default_factory=list)
+    follows: List[tuple] = field(default_factory=list)
+
+    def user_id(self) -> str:
+        return self.rng.choice(self.dataset.user_ids)
+
+    def tweet_id(self) -> str:
+        return self.rng.choice(self.dataset.tweet_ids)
+
+    def author(self, user_id:str) -> dict:
+        user = dict(self.users[user_id])
+        del user["password"]
+        return user
+
+    def new_user(self) -> dict:
+        return {
+            "user_id": str(uuid4()),
+            "email": f"{uuid4().hex}@example.com",
+            "password": self.dataset.password,
+            "first_name": "Erick",
+            "last_name": "Escobar",
+            "birth_date": "1990-01-01"
+        }
+
+    def new_tweet(self) -> dict:
+        return {
+            "tweet_id": str(uuid4()),
+            "content": " ".join(self.rng.choices(WORDS, k=8)),
+            "by": self.author(self.user_id())
+        }
+
+@dataclass
+class Scenario:
+    name: str
+    # Keyword arguments of ASGIClient.request for the next request
+    request: Callable[[Context],dict]
+    expect: int = 200
+    # Fraction of --requests to run
+    share: float = 1.0
+    # Called with the request and the response body of a success
+    done: Callable[[Context,dict,bytes],None] = None
+
+def signed_up(context:Context, request:dict, body:bytes):
+    context.signed_up.append(request["json_body"]["user_id"])
+
+def posted(context:Context, request:dict, body:bytes):
+    context.tweets.append(request["json_body"]["tweet_id"])
+
+def followed(context:Context, request:dict, body:bytes):
+    pair = request["path"].split("/")[2::2]
+    if pair not in context.follows:
+        context.follows.append(pair)
+
+def search_query(context:Context) -> str:
+    return " ".join(context.rng.sample(WORDS, 2))
+
+def window(context:Context) -> dict:
+    """
+    A random day of the year the generated tweets span
+    """
+    since = START + timedelta(days=context.rng.randrange(365))
+    return {"since": str(since), "until": str(since + timedelta(days=1))}
+
+SCENARIOS = [
+    Scenario("GET /", lambda c: {"method": "GET", "path": "/"}),
+    Scenario(
+        "GET / (ndjson)",
+        lambda c: {"method": "GET", "path": "/", "headers": {"accept": "application/x-ndjson"}},
+        share=0.01
+    ),
+    Scenario(
+        "GET / (gzip)",
+        lambda c: {"method": "GET", "path": "/", "headers": {"accept-encoding": "gzip"}}
+    ),
+    Scenario("GET /users", lambda c: {"method": "GET", "path": "/users"}),
+    Scenario("GET /users/{user_id}", lambda c: {"method": "GET", "path": f"/users/{c.user_id()}"}),
+    Scenario(
+        "GET /users/{user_id}/timeline",
+        lambda c: {"method": "GET", "path": f"/users/{c.user_id()}/timeline"}
+    ),
+    Scenario(
+        "GET /users/{user_id}/tweets",
+        lambda c: {"method": "GET", "path": f"/users/{c.user_id()}/tweets"}
+    ),
+    Scenario("GET /tweets/{tweet_id}", lambda c: {"method": "GET", "path": f"/tweets/{c.tweet_id()}"}),
+    Scenario(
+        "GET /tweets?ids=",
+        lambda c: {"method": "GET", "path": "/tweets", "params": {"ids": [c.tweet_id() for _ in range(20)]}}
+    ),
+    Scenario(
+        "GET /tweets?since=&until=",
+        lambda c: {"method": "GET", "path": "/tweets", "params": window(c)}
+    ),
+    Scenario(
+        "GET /tweets/search",
+        lambda c: {"method": "GET", "path": "/tweets/search", "params": {"q": search_query(c)}}
+    ),
+    Scenario(
+        "POST /signup",
+        lambda c: {"method": "POST", "path": "/signup", "json_body": c.new_user()},
+        expect=201, share=0.1, done=signed_up
+    ),
+    Scenario(
+        "POST /login",
+        lambda c: {
+            "method": "POST",
+            "path": "/login",
+            "form": {"email": c.rng.choice(c.dataset.emails), "password": c.dataset.password}
+        },
+        share=0.1
+    ),
+    Scenario(
+        "PUT /users/{user_id}",
+        lambda c: {
+            "method": "PUT",
+            "path": f"/users/{c.signed_up[-1]}",
+            "json_body": dict(c.new_user(), user_id=c.signed_up[-1])
+        },
+        share=0.1
+    ),
+    Scenario(
+        "POST /users/bulk",
+        lambda c: {"method": "POST", "path": "/users/bulk", "json_body": [c.new_user() for _ in range(10)]},
+        expect=201, share=0.01
+    ),
+    Scenario(
+        "POST /post",
+        lambda c: {"method": "POST", "path": "/post", "json_body": c.new_tweet()},
+        expect=201, done=posted
+    ),
+    Scenario(
+        "PUT /tweets/{tweet_id}",
+        lambda c: {
+            "method": "PUT",
+            "path": f"/tweets/{c.rng.choice(c.tweets)}",
+            "form": {"content": search_query(c)}
+        }
+    ),
+    Scenario(
+        "POST /tweets/bulk",
+        lambda c: {"method": "POST", "path": "/tweets/bulk", "json_body": [c.new_tweet() for _ in range(100)]},
+        expect=201, share=0.05
+    ),
+    Scenario(
+        "POST /users/{user_id}/following/{followee_id}",
+        lambda c: {"method": "POST", "path": f"/users/{c.signed_up[0]}/following/{c.user_id()}"},
+        expect=201, done=followed
+    ),
+    Scenario(
+        "DELETE /users/{user_id}/following/{followee_id}",
+        lambda c: {"method": "DELETE", "path": "/users/{}/following/{}".format(*c.follows.pop())}
+    ),
+    Scenario("DELETE /tweets/{tweet_id}", lambda c: {"method": "DELETE", "path": f"/tweets/{c.tweets.pop()}"}),
+    Scenario(
+        "DELETE /users/{user_id}",
+        lambda c: {"method": "DELETE", "path": f"/users/{c.signed_up.pop()}"},
+        share=0.1
+    )
+]
+
+def percentile(latencies:List[float], p:float) -> float:
+    """
+    Nearest-rank percentile of sorted latencies
+    """
+    index = max(0, min(len(latencies) - 1, round(p / 100 * len(latencies)) - 1))
+    return latencies[index]
+
+async def run_scenario(client:ASGIClient, scenario:Scenario, context:Context, requests:int, concurrency:int) -> dict:
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            try:
+                request = scenario.request(context)
+            except IndexError:
+                # Nothing left for a delete scenario
+                return
+            start = time.perf_counter()
+            status, _, body = await client.request(**request)
+            latencies.append(time.perf_counter() - start)
+            if status != scenario.expect:
+                errors += 1
+            elif scenario.done is not None:
+                scenario.done(context, request, body)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    if not latencies:
+        return {"requests": 0, "errors": 0}
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1e3, 3),
+        "p50_ms": round(percentile(latencies, 50) * 1e3, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1e3, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1e3, 3)
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+async def run(args) -> dict:
+    directory = args.data or tempfile.mkdtemp(prefix="twitter-bench-")
+    start = time.perf_counter()
+    dataset = generate(directory, args.users, args.tweets, args.follows, args.seed)
+    generated = time.perf_counter() - start
+    use(directory)
+
+    import main as app_module
+
+    client = ASGIClient(app_module.app)
+    start = time.perf_counter()
+    await client.startup()
+    loaded = time.perf_counter() - start
+    # Peak resident memory once loaded (kB on Linux)
+    startup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024 if resource else None
+    context = Context(dataset, random.Random(args.seed), users=app_module.repository.users.rows)
+
+    selected = [
+        scenario for scenario in SCENARIOS
+        if not args.routes or any(route in scenario.name for route in args.routes)
+    ]
+    routes = {}
+    try:
+        for scenario in selected:
+            requests = max(1, int(args.requests * scenario.share))
+            routes[scenario.name] = result = await run_scenario(
+                client, scenario, context, requests, args.concurrency
+            )
+            print(
+                f"{scenario.name:50} {result.get('throughput', 0):10.1f} req/s"
+                f" p50 {result.get('p50_ms', 0):8.2f} ms"
+                f" p95 {result.get('p95_ms', 0):8.2f} ms"
+                f" p99 {result.get('p99_ms', 0):8.2f} ms"
+                + (f"  {result['errors']} errors" if result["errors"] else ""),
+                flush=True
+            )
+    finally:
+        await client.shutdown()
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "storage": os.environ.get("TWITTER_STORAGE", "json"),
+            "users": args.users,
+            "tweets": args.tweets,
+            "follows_per_user": args.follows,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "generate_s": round(generated, 3),
+            "startup_s": round(loaded, 3),
+            "startup_rss_mb": startup_rss
+        },
+        "routes": routes
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--tweets", type=int, default=10_000)
+    parser.add_argument("--follows", type=int, default=20, help="follows per user")
+    parser.add_argument("--requests", type=int, default=1_000, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--routes", nargs="*", help="only run routes whose name contains one of these")
+    parser.add_argument("--data", help="directory for the dataset, a temporary one by default")
+    parser.add_argument("--output", default="benchmarks/results.json")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(json.dumps(results, indent=2))
+    print(f"results written to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
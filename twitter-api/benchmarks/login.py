@@ -0,0 +1,63 @@
+"""
+Login benchmark
+
+Logins per second against a user table of --users users, driven in
+process through the ASGI app. Also compares the email index lookup with
+the linear scan login() used to do.
+
+    python -m benchmarks.login --users 100000 --requests 2000
+"""
+# Python
+import time
+import random
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.dataset import generate,use
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--requests", type=int, default=2_000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="twitter-bench-")
+    dataset = generate(directory, args.users, tweets=0, follows_per_user=0)
+    use(directory)
+
+    from fastapi.testclient import TestClient
+    import main as app_module
+
+    with TestClient(app_module.app) as client:
+        repository = app_module.repository
+        emails = [random.choice(dataset.emails) for _ in range(1_000)]
+
+        start = time.perf_counter()
+        for email in emails:
+            next(user for user in repository.users.all() if user["email"] == email)
+        scan = (time.perf_counter() - start) / len(emails)
+
+        start = time.perf_counter()
+        for email in emails:
+            repository.users.find(repository.users_by_email, email)
+        index = (time.perf_counter() - start) / len(emails)
+
+        print(f"users: {args.users}")
+        print(f"lookup linear scan: {scan * 1e6:10.1f} us")
+        print(f"lookup email index: {index * 1e6:10.1f} us")
+
+        def login(_):
+            email = random.choice(dataset.emails)
+            response = client.post("/login", data={"email": email, "password": dataset.password})
+            assert response.json()["message"] == "Login Successfully!"
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(login, range(args.requests)))
+        elapsed = time.perf_counter() - start
+        print(f"logins/sec ({args.concurrency} clients): {args.requests / elapsed:10.1f}")
+
+if __name__ == "__main__":
+    main()
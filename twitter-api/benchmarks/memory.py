@@ -0,0 +1,93 @@
+"""
+Memory benchmark
+
+Memory held by the tweets table with one dict per tweet (as loaded from
+json) and in columns (ColumnarRows), measured with tracemalloc for each
+size in --tweets, and the time to read every field of every tweet.
+
+    python -m benchmarks.memory --tweets 100000 1000000
+"""
+# Python
+import gc
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from backends import JSONBackend
+from columns import ColumnarRows
+from storage import TWEET_COLUMNS
+from benchmarks.dataset import generate
+
+def measure(build) -> tuple:
+    """
+    Bytes still allocated once build() returns, and what it returned
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        allocated, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return allocated, result
+
+def read_all(rows) -> float:
+    start = time.perf_counter()
+    for record in rows.values():
+        for field in record:
+            record[field]
+    return time.perf_counter() - start
+
+def run(tweets:int, users:int) -> dict:
+    directory = tempfile.mkdtemp(prefix="twitter-memory-")
+    generate(directory, users, tweets, follows_per_user=0)
+    path = f"{directory}/tweets.json"
+
+    def dicts():
+        return JSONBackend(path, "tweet_id").read()
+
+    def columns():
+        rows = dicts()
+        columnar = ColumnarRows("tweet_id", TWEET_COLUMNS)
+        for key in list(rows):
+            columnar[key] = rows.pop(key)
+        return columnar
+
+    result = {"tweets": tweets, "users": users}
+    for name, build in (("dicts", dicts), ("columns", columns)):
+        allocated, rows = measure(build)
+        result[name] = {
+            "mb": round(allocated / 2 ** 20, 1),
+            "bytes_per_tweet": round(allocated / tweets),
+            "read_all_s": round(read_all(rows), 3)
+        }
+        del rows
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tweets", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--output", default="benchmarks/results-memory.json")
+    args = parser.parse_args()
+
+    results = []
+    for tweets in args.tweets:
+        result = run(tweets, args.users)
+        results.append(result)
+        print(
+            f"{tweets:>9} tweets: dicts {result['dicts']['mb']:8.1f} MB"
+            f" ({result['dicts']['bytes_per_tweet']} B/tweet),"
+            f" columns {result['columns']['mb']:8.1f} MB"
+            f" ({result['columns']['bytes_per_tweet']} B/tweet),"
+            f" read all {result['dicts']['read_all_s']:.2f}s / {result['columns']['read_all_s']:.2f}s",
+            flush=True
+        )
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Multi-worker benchmark
+
+Runs `uvicorn main:app --workers N` on SQLite for each N in --workers and
+drives it from --clients processes over HTTP. Measures read and write
+throughput, then checks that every tweet written through any worker is
+visible, with its last update, from every worker and in the database.
+
+    python -m benchmarks.workers --workers 1 2 4 --clients 8
+"""
+# Python
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import http.client
+from uuid import uuid4
+from multiprocessing import Pool
+from urllib.parse import urlencode
+
+from benchmarks.dataset import generate
+
+HOST = "127.0.0.1"
+
+def request(connection:http.client.HTTPConnection, method:str, path:str, body:bytes = None, headers:dict = None):
+    connection.request(method, path, body=body, headers=headers or {})
+    response = connection.getresponse()
+    return response.status, response.read()
+
+def read_load(args) -> int:
+    port, tweet_ids, duration, seed = args
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection(HOST, port)
+    done = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        status, _ = request(connection, "GET", f"/tweets/{rng.choice(tweet_ids)}")
+        assert status == 200, status
+        done += 1
+    return done
+
+def write_load(args) -> list:
+    """
+    Posts `count` tweets, then updates each of them. Returns their ids
+    """
+    port, author, count = args
+    connection = http.client.HTTPConnection(HOST, port)
+    ids = []
+    for i in range(count):
+        tweet_id = str(uuid4())
+        body = json.dumps({"tweet_id": tweet_id, "content": f"tweet {i}", "by": author}).encode()
+        status, data = request(connection, "POST", "/post", body, {"content-type": "application/json"})
+        assert status == 201, (status, data)
+        ids.append(tweet_id)
+    for tweet_id in ids:
+        body = urlencode({"content": "updated"}).encode()
+        status, data = request(
+            connection, "PUT", f"/tweets/{tweet_id}", body,
+            {"content-type": "application/x-www-form-urlencoded"}
+        )
+        assert status == 200, (status, data)
+    return ids
+
+def check(args) -> int:
+    """
+    Number of tweets missing or not updated, as seen by whichever worker
+    takes this connection
+    """
+    port, ids = args
+    connection = http.client.HTTPConnection(HOST, port)
+    wrong = 0
+    for start in range(0, len(ids), 100):
+        query = urlencode({"ids": ids[start:start + 100]}, doseq=True)
+        status, data = request(connection, "GET", f"/tweets?{query}")
+        assert status == 200, status
+        result = json.loads(data)
+        wrong += len(result["errors"])
+        wrong += sum(tweet["content"] != "updated" for tweet in result["tweets"])
+    return wrong
+
+def wait_ready(port:int, timeout:float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(HOST, port, timeout=1)
+            status, _ = request(connection, "GET", "/users?limit=1")
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("The server didn't start")
+
+def run(workers:int, args, source:str, dataset, port:int) -> dict:
+    directory = tempfile.mkdtemp(prefix="twitter-workers-")
+    for name in ("user.json", "tweets.json", "follows.json"):
+        shutil.copy(os.path.join(source, name), directory)
+    env = dict(
+        os.environ,
+        TWITTER_STORAGE="sqlite",
+        TWITTER_SQLITE_FILE=os.path.join(directory, "twitter.db"),
+        TWITTER_USERS_FILE=os.path.join(directory, "user.json"),
+        TWITTER_TWEETS_FILE=os.path.join(directory, "tweets.json"),
+        TWITTER_FOLLOWS_FILE=os.path.join(directory, "follows.json")
+    )
+    # uvicorn 0.18 doesn't set TCP_NODELAY on connections accepted by its
+    # workers, which adds ~40ms of delayed ACK to every response. Accepted
+    # connections inherit it from a listening socket that has it
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    listener.bind((HOST, port))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--fd", str(listener.fileno()),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        env=env,
+        pass_fds=[listener.fileno()]
+    )
+    try:
+        wait_ready(port)
+        authors = []
+        with sqlite3.connect(env["TWITTER_SQLITE_FILE"]) as db:
+            for record, in db.execute("SELECT record FROM users LIMIT ?", (args.clients,)):
+                author = json.loads(record)
+                del author["password"]
+                authors.append(author)
+            before = db.execute("SELECT COUNT(*) FROM tweets").fetchone()[0]
+
+        with Pool(args.clients) as pool:
+            start = time.perf_counter()
+            reads = sum(pool.map(read_load, [
+                (port, dataset.tweet_ids, args.duration, seed) for seed in range(args.clients)
+            ]))
+            read_throughput = reads / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            written = pool.map(write_load, [
+                (port, authors[i % len(authors)], args.writes) for i in range(args.clients)
+            ])
+            write_throughput = 2 * args.writes * args.clients / (time.perf_counter() - start)
+
+            ids = [tweet_id for chunk in written for tweet_id in chunk]
+            # Let every worker poll the changes of the others
+            time.sleep(1)
+            # New connections land on different workers
+            wrong = sum(pool.map(check, [(port, ids)] * max(args.clients, workers * 2)))
+    finally:
+        server.terminate()
+        server.wait()
+        listener.close()
+
+    with sqlite3.connect(env["TWITTER_SQLITE_FILE"]) as db:
+        stored = db.execute("SELECT COUNT(*) FROM tweets").fetchone()[0] - before
+        updated = db.execute(
+            f"SELECT COUNT(*) FROM tweets WHERE key IN ({','.join('?' * len(ids))}) "
+            "AND json_extract(record, '$.content') = 'updated'",
+            ids
+        ).fetchone()[0]
+    shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "workers": workers,
+        "read_throughput": round(read_throughput, 1),
+        "write_throughput": round(write_throughput, 1),
+        "tweets_written": len(ids),
+        "tweets_stored": stored,
+        "tweets_updated": updated,
+        "stale_reads": wrong,
+        "correct": stored == len(ids) == updated and wrong == 0
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--tweets", type=int, default=10_000)
+    parser.add_argument("--duration", type=float, default=5, help="seconds of reads")
+    parser.add_argument("--writes", type=int, default=200, help="tweets posted and updated per client")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default="benchmarks/results-workers.json")
+    args = parser.parse_args()
+
+    source = tempfile.mkdtemp(prefix="twitter-bench-")
+    dataset = generate(source, args.users, args.tweets)
+    print(f"cpus: {os.cpu_count()}")
+    results = []
+    for workers in args.workers:
+        result = run(workers, args, source, dataset, args.port)
+        results.append(result)
+        print(
+            f"workers {workers:2}: reads {result['read_throughput']:9.1f} req/s,"
+            f" writes {result['write_throughput']:8.1f} req/s,"
+            f" {'correct' if result['correct'] else 'LOST WRITES'}"
+            f" ({result['tweets_stored']}/{result['tweets_written']} stored,"
+            f" {result['tweets_updated']} updated, {result['stale_reads']} stale reads)",
+            flush=True
+        )
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"cpus": os.cpu_count(), "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Columnar rows
+
+A table held as columns instead of one dict per record: timestamps in
+array("q"), references to other records (e.g. the author of a tweet) as
+array("I") codes into a table of distinct values, text as interned
+strings. A record costs a few machine words per field instead of a dict
+and a str per field.
+
+Records are read through ColumnRow views. Records that don't fit the
+columns (other fields, timestamps that don't round-trip) are kept as
+they are.
+"""
+# Python
+import sys
+import weakref
+import threading
+from array import array
+from collections.abc import Mapping,MutableMapping
+from typing import Dict,Iterator,List,Optional
+# Snapshots
+from snapshot import format_time,time_micros
+
+KEY = "key"
+TEXT = "text"
+TIME = "time"
+REF = "ref"
+
+# Timestamp column value of None
+NULL_TIME = -2 ** 63
+
+class ColumnRow(Mapping):
+    """
+    ColumnRow
+
+    Read-only view of one record of ColumnarRows. Views handed out by
+    reading a record are detached (given a copy of the record) when the
+    record is written, so they keep showing the version they were made
+    for. Other views, made by items(), stop working instead
+    """
+    __slots__ = ("rows", "key", "slot", "record", "__weakref__")
+
+    def __init__(self, rows:"ColumnarRows", key:str, slot:int):
+        self.rows = rows
+        self.key = key
+        self.slot = slot
+        self.record: Optional[dict] = None
+
+    def __getitem__(self, field:str):
+        if self.record is None:
+            # Detaching happens under the same lock, so the slot can't
+            # be freed between the check and the read
+            with self.rows.lock:
+                if self.record is None:
+                    return self.rows.value(self.key, self.slot, field)
+        return self.record[field]
+
+    def __iter__(self) -> Iterator[str]:
+        if self.record is not None:
+            return iter(self.record)
+        return iter(self.rows.fields)
+
+    def __len__(self) -> int:
+        if self.record is not None:
+            return len(self.record)
+        return len(self.rows.fields)
+
+    def __contains__(self, field) -> bool:
+        if self.record is not None:
+            return field in self.record
+        return field in self.rows.fields
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+    def detach(self):
+        self.record = dict(self)
+
+class ColumnarRows(MutableMapping):
+    """
+    ColumnarRows
+
+    The rows of a Table, one column per field of `fields` (field -> KEY,
+    TEXT, TIME or REF). The field of kind KEY is the key of the table;
+    the key strings are the ones the indexes hold, so they aren't stored
+    again.
+
+    Freed slots are reused. Reading a record gives the same ColumnRow as
+    long as it is in use (SerializedCache relies on it).
+
+    Records are read from request threads while the Writer writes them;
+    `lock` covers handing out a view, reading a column, and detaching
+    views and switching slots on a write.
+    """
+    def __init__(self, key:str, fields:Dict[str,str]):
+        self.key = key
+        self.fields = tuple(fields)
+        self.kinds = dict(fields)
+        self.slots: Dict[str,int] = {}
+        self.free: List[int] = []
+        self.capacity = 0
+        self.texts: Dict[str,list] = {}
+        self.times: Dict[str,array] = {}
+        # Codes of a REF column index its distinct values, 0 is None
+        self.codes: Dict[str,array] = {}
+        self.refs: Dict[str,list] = {}
+        self.ref_codes: Dict[str,Dict[str,int]] = {}
+        for field, kind in fields.items():
+            if kind == TEXT:
+                self.texts[field] = []
+            elif kind == TIME:
+                self.times[field] = array("q")
+            elif kind == REF:
+                self.codes[field] = array("I")
+                self.refs[field] = [None]
+                self.ref_codes[field] = {}
+        # Records that don't fit the columns
+        self.other: Dict[str,dict] = {}
+        self.views: "weakref.WeakValueDictionary[str,ColumnRow]" = weakref.WeakValueDictionary()
+        self.lock = threading.RLock()
+
+    def fits(self, key:str, record:Mapping) -> bool:
+        if len(record) != len(self.fields) or record.get(self.key) != key:
+            return False
+        for field, kind in self.kinds.items():
+            if field not in record:
+                return False
+            value = record[field]
+            if value is None or kind == KEY:
+                continue
+            if not isinstance(value, str) or (kind == TIME and time_micros(value) is None):
+                return False
+        return True
+
+    def value(self, key:str, slot:int, field:str):
+        if self.slots.get(key) != slot:
+            # A view made by items() of a record deleted since
+            raise KeyError(field)
+        kind = self.kinds.get(field)
+        if kind == TEXT:
+            return self.texts[field][slot]
+        if kind == TIME:
+            micros = self.times[field][slot]
+            return None if micros == NULL_TIME else format_time(micros)
+        if kind == REF:
+            return self.refs[field][self.codes[field][slot]]
+        if kind == KEY:
+            return key
+        raise KeyError(field)
+
+    def code(self, field:str, value:Optional[str]) -> int:
+        if value is None:
+            return 0
+        codes = self.ref_codes[field]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.refs[field])
+            self.refs[field].append(value)
+        return code
+
+    def allocate(self) -> int:
+        if self.free:
+            return self.free.pop()
+        for column in self.texts.values():
+            column.append(None)
+        for column in self.times.values():
+            column.append(NULL_TIME)
+        for column in self.codes.values():
+            column.append(0)
+        self.capacity += 1
+        return self.capacity - 1
+
+    def release(self, slot:int):
+        for column in self.texts.values():
+            # Don't keep the text alive
+            column[slot] = None
+        self.free.append(slot)
+
+    def detach(self, key:str):
+        view = self.views.pop(key, None)
+        if view is not None:
+            view.detach()
+
+    def __getitem__(self, key:str) -> Mapping:
+        with self.lock:
+            record = self.other.get(key)
+            if record is not None:
+                return record
+            slot = self.slots[key]
+            view = self.views.get(key)
+            if view is None or view.slot != slot:
+                view = ColumnRow(self, key, slot)
+                self.views[key] = view
+            return view
+
+    def __contains__(self, key) -> bool:
+        return key in self.slots or key in self.other
+
+    def __setitem__(self, key:str, record:Mapping):
+        # Read the record (it may be a view of this key) before any change
+        fits = self.fits(key, record)
+        if fits:
+            texts = {field: record[field] for field in self.texts}
+            times = {
+                field: NULL_TIME if record[field] is None else time_micros(record[field])
+                for field in self.times
+            }
+            refs = {field: record[field] for field in self.codes}
+        with self.lock:
+            self.detach(key)
+            old = self.slots.get(key)
+            if not fits:
+                self.other[key] = record
+                if old is not None:
+                    del self.slots[key]
+                    self.release(old)
+                return
+            slot = self.allocate()
+            for field, value in texts.items():
+                self.texts[field][slot] = sys.intern(value) if value is not None else None
+            for field, micros in times.items():
+                self.times[field][slot] = micros
+            for field, value in refs.items():
+                self.codes[field][slot] = self.code(field, value)
+            self.slots[key] = slot
+            self.other.pop(key, None)
+            if old is not None:
+                self.release(old)
+
+    def __delitem__(self, key:str):
+        with self.lock:
+            if key in self.other:
+                del self.other[key]
+                return
+            self.detach(key)
+            self.release(self.slots.pop(key))
+
+    def __len__(self) -> int:
+        return len(self.slots) + len(self.other)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from list(self.slots)
+        yield from list(self.other)
+
+    def items(self) -> Iterator[tuple]:
+        """
+        Views made here aren't kept for reuse, so walking every record
+        doesn't fill the weak map
+        """
+        with self.lock:
+            slots = list(self.slots.items())
+            other = list(self.other.items())
+        for key, slot in slots:
+            view = self.views.get(key)
+            yield key, ColumnRow(self, key, slot) if view is None else view
+        yield from other
+
+    def values(self) -> Iterator[Mapping]:
+        for _, record in self.items():
+            yield record
+
+    def copy(self) -> "ColumnarRows":
+        """
+        The current rows in columns of their own, made with a few memory
+        copies, for a snapshot to be written from while writes go on
+        """
+        rows = ColumnarRows(self.key, self.kinds)
+        with self.lock:
+            rows.slots = dict(self.slots)
+            rows.free = list(self.free)
+            rows.capacity = self.capacity
+            rows.texts = {field: list(column) for field, column in self.texts.items()}
+            rows.times = {field: array("q", column) for field, column in self.times.items()}
+            rows.codes = {field: array("I", column) for field, column in self.codes.items()}
+            rows.refs = {field: list(values) for field, values in self.refs.items()}
+            rows.ref_codes = self.ref_codes
+            rows.other = dict(self.other)
+        return rows
@@ -1,18 +1,70 @@
 # Python
-import json
+import os
+import gzip
+import time
+import zlib
+import hashlib
+from collections import OrderedDict
+from email.utils import formatdate
 from uuid import UUID
 from datetime import date,datetime
-from typing import Optional,List
+from typing import Awaitable,Callable,Iterable,Optional,List,Tuple,Union
+from asyncio import Future,gather,get_running_loop,shield
 # Pydantic
 from pydantic import BaseModel
 from pydantic import EmailStr
 from pydantic import Field
+from pydantic import conlist
 #FastAPI
 from fastapi import FastAPI
 from fastapi import status,HTTPException
-from fastapi import Body,Path,Form
+from fastapi import Body,Path,Form,Query,Header
+from fastapi import Response
+from fastapi.responses import JSONResponse,StreamingResponse
+# AnyIO
+from anyio import to_thread
+# Brotli, optional
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# Storage
+from storage import Conflict,Repository,SerializedCache,public
+from storage import decode_cursor,encode_cursor,follow_id,timestamp
+from passwords import run_hasher,dummy_hash,hash_password,is_hashed,verify_password
+# Metrics
+from metrics import MetricsMiddleware,registry
+from metrics import cache_evictions,cache_hits,cache_misses
+import profiling
+
+# Size of the threadpool for sync code (streamed listings); path
+# operations are async and never wait on it
+THREADPOOL_SIZE = int(os.environ.get("TWITTER_THREADPOOL_SIZE", "40"))
 
 app = FastAPI()
+repository = Repository()
+app.add_middleware(MetricsMiddleware, routes=lambda: app.routes)
+if profiling.enabled():
+    app.add_middleware(profiling.ProfilingMiddleware, routes=lambda: app.routes)
+
+# Read on scrape, so they cost nothing in between
+registry.gauge(
+    "twitter_table_rows", "Records in memory", ("table",),
+    function=lambda: {(table.backend.table,): len(table.rows) for table in repository.tables}
+)
+registry.gauge(
+    "twitter_writer_queue_depth", "Mutations waiting for the writer",
+    function=lambda: {(): repository.writer.queue.qsize() if repository.writer else 0}
+)
+
+@app.on_event("startup")
+async def load_repository():
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    await repository.aload()
+
+@app.on_event("shutdown")
+async def close_repository():
+    await repository.aclose()
 
 # Models
 
@@ -45,7 +97,7 @@ class User(UserBase):
 class UserRegister(User,UserLogin):
     pass
 
-class Tweets(BaseModel):
+class TweetBase(BaseModel):
     tweet_id: UUID = Field(...)
     content: str = Field(
         ...,
@@ -53,14 +105,444 @@ class Tweets(BaseModel):
         max_length = 256,
         example = "Este es un tweet"
         )
-    created_at: datetime = Field(default=datetime.now())
+    created_at: datetime = Field(default_factory=datetime.now)
     updated_at: Optional[datetime] = Field(default=None)
+
+class Tweets(TweetBase):
     by:User = Field(...)
 
+class Follow(BaseModel):
+    follower_id: UUID = Field(...)
+    followee_id: UUID = Field(...)
+    created_at: datetime = Field(...)
+
+class BulkError(BaseModel):
+    id: str = Field(...)
+    detail: str = Field(...)
+
+class UsersBulkOut(BaseModel):
+    users: List[User] = Field(default=[])
+    errors: List[BulkError] = Field(default=[])
+
+class TweetsBulkOut(BaseModel):
+    tweets: List[Tweets] = Field(default=[])
+    errors: List[BulkError] = Field(default=[])
+
 class LoginOut(BaseModel):
     email: EmailStr = Field(...)
     message: str = Field(default="Login Successfully!")
 
+# Records
+
+BULK_SIZE = 1000
+
+def user_record(user:UserRegister, password_hash:str) -> dict:
+    user_dict = user.dict()
+    user_dict["user_id"] = str(user_dict["user_id"])
+    if user_dict["birth_date"] is not None:
+        user_dict["birth_date"] = str(user_dict["birth_date"])
+    user_dict["password"] = password_hash
+    return user_dict
+
+def tweet_record(tweet:Tweets) -> dict:
+    """
+    The record of a new tweet. The server sets its timestamps, whatever
+    the body says, so the created_at order is the posting order
+    """
+    tweet_dict = tweet.dict()
+    tweet_dict["tweet_id"] = str(tweet_dict["tweet_id"])
+    tweet_dict["created_at"] = str(datetime.now())
+    tweet_dict["updated_at"] = None
+    tweet_dict["author_id"] = str(tweet_dict.pop("by")["user_id"])
+    return tweet_dict
+
+# Compression
+
+COMPRESS_MIN_SIZE = int(os.environ.get("TWITTER_COMPRESS_MIN_SIZE", "1024"))
+COMPRESSED_PAGES = int(os.environ.get("TWITTER_COMPRESSED_PAGES", "256"))
+
+ENCODERS = {"gzip": lambda data: gzip.compress(data, compresslevel=6)}
+if brotli is not None:
+    ENCODERS["br"] = lambda data: brotli.compress(data, quality=5)
+# Best ratio first, for clients that accept several equally
+PREFERENCE = ("br", "gzip")
+
+def pick_encoding(accept_encoding:Optional[str]) -> Optional[str]:
+    """
+    The encoding to use for an Accept-Encoding header, None for identity
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                continue
+        weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in PREFERENCE:
+        if encoding not in ENCODERS:
+            continue
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+class CompressedPages:
+    """
+    CompressedPages
+
+    LRU of compressed listing pages, keyed by their ETag and encoding.
+    The ETag changes with any write to the tables the page comes from, so
+    entries never go stale, they just stop being asked for.
+    """
+    def __init__(self, size:int):
+        self.size = size
+        self.entries: "OrderedDict[tuple,Tuple[bytes,dict]]" = OrderedDict()
+
+    def get(self, key:tuple) -> Optional[Tuple[bytes,dict]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            cache_misses.inc("pages")
+            return None
+        self.entries.move_to_end(key)
+        cache_hits.inc("pages")
+        return entry
+
+    def put(self, key:tuple, data:bytes, headers:dict):
+        self.entries[key] = (data, headers)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            cache_evictions.inc("pages", "size")
+
+compressed_pages = CompressedPages(COMPRESSED_PAGES)
+
+def cached_page(headers:dict, accept_encoding:Optional[str]) -> Optional[Response]:
+    """
+    The compressed page made by json_list() for these validators, if it
+    is still cached
+    """
+    encoding = pick_encoding(accept_encoding)
+    if encoding is None:
+        return None
+    entry = compressed_pages.get(("W/" + headers["ETag"], encoding))
+    if entry is None:
+        return None
+    data, cached_headers = entry
+    return json_response(data, cached_headers)
+
+# Serialized responses
+
+JSON = "application/json"
+SEPARATORS = (",", ":")
+
+def serialize_user(user:dict) -> bytes:
+    return User(**public(user)).json(separators=SEPARATORS).encode()
+
+def serialize_tweet(tweet:dict) -> bytes:
+    """
+    The tweet without its author, up to (not including) the closing brace
+    """
+    return TweetBase(**tweet).json(separators=SEPARATORS).encode()[:-1]
+
+user_cache = repository.users.add_index(SerializedCache(serialize_user, "users"))
+tweet_cache = repository.tweets.add_index(SerializedCache(serialize_tweet, "tweets"))
+registry.gauge(
+    "twitter_cache_entries", "Entries in a cache", ("cache",),
+    function=lambda: {(cache.name,): len(cache) for cache in (user_cache, tweet_cache)}
+)
+
+def user_json(user:dict, store:bool = True) -> bytes:
+    return user_cache.get(user["user_id"], user, store)
+
+def tweet_json(tweet:dict, store:bool = True) -> Optional[bytes]:
+    """
+    The tweet as a Tweets json, put together from the cached bytes of the
+    tweet and of its author. None if the author doesn't exist anymore.
+    With store=False nothing is added to the caches
+    """
+    if "author_id" in tweet:
+        author = repository.users.get(tweet["author_id"])
+        if author is None:
+            return None
+        author_json = user_json(author, store)
+    else:
+        # Tweet of an unregistered author, still embedding a copy of it
+        author_json = User(**public(tweet["by"])).json(separators=SEPARATORS).encode()
+    return tweet_cache.get(tweet["tweet_id"], tweet, store) + b',"by":' + author_json + b"}"
+
+def written_tweet(tweet:Optional[dict]):
+    """
+    The response to a write of a tweet: 404 if there was no tweet, the
+    tweet without "by" if its author is gone (the write happened anyway)
+    """
+    if tweet is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="¡This tweet_id doesn't exist!"
+        )
+    joined = repository.join(tweet)
+    if joined is None:
+        return json_response(serialize_tweet(tweet) + b"}")
+    return joined
+
+def json_response(data:bytes, headers:Optional[dict] = None) -> Response:
+    return Response(content=data, media_type=JSON, headers=headers)
+
+def json_array(items:Iterable[Optional[bytes]]) -> bytes:
+    return b"[" + b",".join(item for item in items if item is not None) + b"]"
+
+def json_list(
+    items:Iterable[Optional[bytes]],
+    next_cursor:Optional[str] = None,
+    headers:Optional[dict] = None,
+    accept_encoding:Optional[str] = None
+) -> Response:
+    """
+    A json array of pre-serialized items; the cursor of the next page
+    goes in the X-Next-Cursor header.
+
+    Compressed if the client accepts it and the array is large enough.
+    When `headers` has an ETag the compressed page is kept, see
+    cached_page()
+    """
+    headers = dict(headers or {})
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    headers["Vary"] = "Accept-Encoding"
+    data = json_array(items)
+    encoding = pick_encoding(accept_encoding)
+    if encoding is None or len(data) < COMPRESS_MIN_SIZE:
+        return json_response(data, headers)
+    data = ENCODERS[encoding](data)
+    headers["Content-Encoding"] = encoding
+    if "ETag" in headers:
+        # The compressed bytes differ, but the json is the same
+        headers["ETag"] = "W/" + headers["ETag"]
+        compressed_pages.put((headers["ETag"], encoding), data, headers)
+    return json_response(data, headers)
+
+# Conditional requests
+
+def validators(*parts) -> dict:
+    """
+    ETag and Last-Modified headers for a response made from the given
+    (table, key) versions (key None for the whole table) and request
+    parameters. Nothing is read or serialized to compute them
+    """
+    tags = []
+    modified = 0.0
+    for part in parts:
+        if isinstance(part, tuple):
+            table, key = part
+            epoch, version, changed = table.version(key)
+            tags.append(f"{epoch}.{version}")
+            modified = max(modified, changed)
+        else:
+            tags.append(format(zlib.crc32(str(part).encode()), "x"))
+    return {
+        "ETag": '"' + "-".join(tags) + '"',
+        "Last-Modified": formatdate(modified, usegmt=True)
+    }
+
+def not_modified(if_none_match:Optional[str], headers:dict) -> Optional[Response]:
+    """
+    A 304 response if the client already has this version
+    """
+    if if_none_match is None:
+        return None
+    etag = headers["ETag"]
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    if "*" in tags or etag in tags or "W/" + etag in tags:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return None
+
+# Pagination
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def paginate(
+    table,
+    index,
+    limit:int,
+    cursor:Optional[str],
+    descending:bool = False,
+    low = None,
+    high = None
+) -> Tuple[list,Optional[str]]:
+    """
+    Returns one page of the table (or of the records with low <= sort
+    key < high) and the cursor of the next one
+    """
+    try:
+        return table.page(index, limit, cursor, descending, low, high)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="¡This cursor is not valid!"
+        )
+
+# Streaming
+
+NDJSON = "application/x-ndjson"
+
+def wants_ndjson(accept:Optional[str]) -> bool:
+    return accept is not None and NDJSON in accept
+
+def ndjson(table, index, encode, descending:bool = False, low = None, high = None) -> StreamingResponse:
+    """
+    Streams the whole table (or the records with low <= sort key < high)
+    as newline delimited json, one chunk of records at a time, without
+    building the full list in memory.
+
+    Records are encoded with store=False: an export walks more records
+    than the caches hold and would evict every hot one
+    """
+    def lines():
+        for records in table.scan(index, descending=descending, low=low, high=high):
+            yield b"".join(
+                data + b"\n"
+                for data in (encode(record, store=False) for record in records)
+                if data is not None
+            )
+    return StreamingResponse(lines(), media_type=NDJSON)
+
+# Time ranges
+
+def tweets_between(
+    since:Optional[datetime],
+    until:Optional[datetime],
+    limit:int,
+    cursor:Optional[str],
+    accept:Optional[str],
+    accept_encoding:Optional[str],
+    if_none_match:Optional[str]
+) -> Response:
+    """
+    A page of the tweets created in [since, until), a range scan of the
+    created_at index
+    """
+    low = timestamp(since) if since is not None else None
+    high = timestamp(until) if until is not None else None
+    if low is not None and high is not None and low > high:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="¡since must not be after until!"
+        )
+    if wants_ndjson(accept):
+        return ndjson(repository.tweets, repository.tweets_by_date, tweet_json, True, low, high)
+    headers = validators((repository.tweets, None), (repository.users, None), low, high, limit, cursor)
+    cached = not_modified(if_none_match, headers) or cached_page(headers, accept_encoding)
+    if cached is not None:
+        return cached
+    tweets, next_cursor = paginate(
+        repository.tweets, repository.tweets_by_date, limit, cursor, True, low, high
+    )
+    return json_list(map(tweet_json, tweets), next_cursor, headers, accept_encoding)
+
+# Conflicts
+
+@app.exception_handler(Conflict)
+async def conflict(request, e:Conflict) -> JSONResponse:
+    """
+    409 for writes that would duplicate a key or an email
+    """
+    return JSONResponse(
+        status_code=status.HTTP_409_CONFLICT,
+        content={"detail": conflict_detail(e)}
+    )
+
+def conflict_detail(e:Conflict) -> str:
+    return f"¡This {e.field} already exists!"
+
+# Idempotency
+
+IDEMPOTENCY_KEYS = int(os.environ.get("TWITTER_IDEMPOTENCY_KEYS", "10000"))
+IDEMPOTENCY_TTL = float(os.environ.get("TWITTER_IDEMPOTENCY_TTL", "86400"))
+
+# Result of a request that failed, see IdempotencyKeys.run()
+FAILED = object()
+
+class IdempotencyKeys:
+    """
+    IdempotencyKeys
+
+    Results of the POSTs made with an Idempotency-Key header, so a client
+    that retries one (e.g. after a timeout under load) gets the result of
+    the first request instead of writing again. A retry that comes while
+    the first request is still running waits for it.
+
+    Kept in memory, by each process, for `ttl` seconds and at most `size`
+    keys. Requests that fail aren't kept, so they can be retried
+    """
+    def __init__(self, size:int, ttl:float):
+        self.size = size
+        self.ttl = ttl
+        self.entries: "OrderedDict[tuple,Tuple[str,float,Future]]" = OrderedDict()
+
+    def expire(self, now:float):
+        while self.entries:
+            _, created, future = next(iter(self.entries.values()))
+            if now - created < self.ttl or not future.done():
+                return
+            self.entries.popitem(last=False)
+            cache_evictions.inc("idempotency", "ttl")
+
+    async def run(self, scope:str, key:str, fingerprint:str, handler:Callable[[],Awaitable]):
+        """
+        The result of handler(), or of the first request made with this
+        key. Raises a 422 if that request had another body
+        """
+        now = time.monotonic()
+        self.expire(now)
+        entry = self.entries.get((scope, key))
+        if entry is not None:
+            if entry[0] != fingerprint:
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="¡This Idempotency-Key was used with another request!"
+                )
+            cache_hits.inc("idempotency")
+            result = await shield(entry[2])
+            if result is not FAILED:
+                return result
+            return await self.run(scope, key, fingerprint, handler)
+        cache_misses.inc("idempotency")
+        future = get_running_loop().create_future()
+        self.entries[(scope, key)] = (fingerprint, now, future)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            cache_evictions.inc("idempotency", "size")
+        try:
+            result = await handler()
+        except BaseException:
+            if self.entries.get((scope, key), (None, None, None))[2] is future:
+                del self.entries[(scope, key)]
+            future.set_result(FAILED)
+            raise
+        future.set_result(result)
+        return result
+
+idempotency_keys = IdempotencyKeys(IDEMPOTENCY_KEYS, IDEMPOTENCY_TTL)
+
+async def idempotent(scope:str, key:Optional[str], body:BaseModel, handler:Callable[[],Awaitable]):
+    """
+    Runs handler() once per Idempotency-Key (if the client sent one).
+    Fields left to their default (e.g. created_at) don't count as
+    another body
+    """
+    if key is None:
+        return await handler()
+    fingerprint = hashlib.sha256(body.json(exclude_unset=True).encode()).hexdigest()
+    return await idempotency_keys.run(scope, key, fingerprint, handler)
+
 # Path Operations
 
 ## Users
@@ -73,7 +555,10 @@ class LoginOut(BaseModel):
     summary="Register a user",
     tags=["Users"]
 )
-def signup(user:UserRegister = Body(...)):
+async def signup(
+    user:UserRegister = Body(...),
+    idempotency_key: Optional[str] = Header(default=None, max_length=255)
+):
     """
     Signup
 
@@ -83,6 +568,8 @@ def signup(user:UserRegister = Body(...)):
 
         -Request body parameters
             -user: UserRegister
+        -Header parameters
+            -idempotency_key: Optional[str]
 
     Returns: A json with the basic user information:
 
@@ -90,26 +577,78 @@ def signup(user:UserRegister = Body(...)):
         -email: EmailStr
         -first_name: str
         -birth_date: date
+
+    409 if the user_id or the email is taken. A retry with the same
+    Idempotency-Key gets the first response instead
     """
-    with open("user.json","r+",encoding="utf-8") as f:
-        results = json.loads(f.read())
-        user_dict = user.dict()
-        user_dict["user_id"] = str(user_dict["user_id"])
-        user_dict["birth_date"] = str(user_dict["birth_date"])
-        results.append(user_dict)
-        f.seek(0)
-        f.write(json.dumps(results))
+    async def register():
+        # Before paying for the hash, the writer checks again
+        repository.users.check(user_record(user, ""))
+        password_hash = await run_hasher(hash_password, user.password)
+        await repository.users.ainsert(user_record(user, password_hash))
         return user
+    return await idempotent("/signup", idempotency_key, user, register)
+
+### Register many users
+@app.post(
+    path='/users/bulk',
+    response_model=UsersBulkOut,
+    status_code=status.HTTP_201_CREATED,
+    summary="Register many users",
+    tags=["Users"]
+)
+async def signup_bulk(users: conlist(UserRegister, min_items=1, max_items=BULK_SIZE) = Body(...)):
+    """
+    Signup Bulk
+
+    This path operation registers up to 1000 users with a single write
+
+    Parameters:
+
+        -Request body parameters
+            -users: List[UserRegister]
+
+    Returns a json with the registered users and the users that were
+    not registered, with the reason:
+
+        -users: List[User]
+        -errors: List[BulkError]
+    """
+    errors = []
+    new_users = []
+    for user in users:
+        try:
+            repository.users.check(user_record(user, ""))
+        except Conflict as e:
+            errors.append(BulkError(id=str(user.user_id), detail=conflict_detail(e)))
+        else:
+            new_users.append(user)
+    password_hashes = await gather(
+        *(run_hasher(hash_password, user.password) for user in new_users)
+    )
+    records = [
+        user_record(user, password_hash)
+        for user, password_hash in zip(new_users, password_hashes)
+    ]
+    registered = []
+    results = await repository.users.ainsert_many(records) if records else []
+    for user, result in zip(new_users, results):
+        if isinstance(result, Conflict):
+            # Taken in the meantime, or twice in this request
+            errors.append(BulkError(id=str(user.user_id), detail=conflict_detail(result)))
+        else:
+            registered.append(user)
+    return UsersBulkOut(users=registered, errors=errors)
 
 ### Login a user
 @app.post(
     path='/login',
-    response_model=User,
+    response_model=LoginOut,
     status_code=status.HTTP_200_OK,
     summary="Login a user",
     tags=["Users"]
 )
-def login(email:EmailStr = Form(...), password:str = Form(...)):
+async def login(email:EmailStr = Form(...), password:str = Form(...)):
     """
     Login
 
@@ -122,13 +661,19 @@ def login(email:EmailStr = Form(...), password:str = Form(...)):
 
     Returns a LoginOut model with username and message
     """
-    with open("user.json", "r+", encoding="utf-8") as f:
-        data = json.loads(f.read())
-        for user in data:
-            if email == user['email'] and password == user['password']:
-                return LoginOut(email=email)
-            else:
-                return LoginOut(email=email, message="Login Unsuccessfully!")
+    user = repository.users.find(repository.users_by_email, email)
+    if user is None:
+        # Pay for a hash anyway, or the response time tells which
+        # emails are registered
+        await run_hasher(verify_password, password, dummy_hash())
+        return LoginOut(email=email, message="Login Unsuccessfully!")
+    if not await run_hasher(verify_password, password, user["password"]):
+        return LoginOut(email=email, message="Login Unsuccessfully!")
+    if not is_hashed(user["password"]):
+        # Plaintext passwords from before hashing get upgraded on login
+        hashed = await run_hasher(hash_password, password)
+        await repository.users.aupdate(user["user_id"], {"password": hashed})
+    return LoginOut(email=email)
 ### Show all users
 @app.get(
     path='/users',
@@ -137,12 +682,34 @@ def login(email:EmailStr = Form(...), password:str = Form(...)):
     summary="Show all users",
     tags=["Users"]
 )
-def show_all_users():
+async def show_all_users(
+    limit: int = Query(
+        default=PAGE_SIZE,
+        ge=1,
+        le=MAX_PAGE_SIZE,
+        title="Page size",
+        description="Maximum number of users in the page"
+    ),
+    cursor: Optional[str] = Query(
+        default=None,
+        title="Cursor",
+        description="X-Next-Cursor header of the previous page"
+    ),
+    accept: Optional[str] = Header(default=None),
+    accept_encoding: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None)
+):
     """
-    This path operation shows all users
+    This path operation shows all users, one page at a time ordered by user_id
 
     Parameters:
-        -
+        - Query parameters:
+            - limit: int
+            - cursor: Optional[str]
+        - Header parameters:
+            - accept: Optional[str]
+            - accept_encoding: Optional[str]
+            - if_none_match: Optional[str]
 
     Returns a json list with all users in the app with the following attributes:
 
@@ -152,10 +719,18 @@ def show_all_users():
         - last_name: str
         - birth_date: date
 
+    The cursor of the next page comes in the X-Next-Cursor header.
+    With "Accept: application/x-ndjson" every user is streamed instead,
+    one json per line
     """
-    with open("user.json","r",encoding="utf-8") as f:
-        results = json.loads(f.read())
-        return results
+    if wants_ndjson(accept):
+        return ndjson(repository.users, repository.users_by_id, user_json)
+    headers = validators((repository.users, None), limit, cursor)
+    cached = not_modified(if_none_match, headers) or cached_page(headers, accept_encoding)
+    if cached is not None:
+        return cached
+    users, next_cursor = paginate(repository.users, repository.users_by_id, limit, cursor)
+    return json_list(map(user_json, users), next_cursor, headers, accept_encoding)
 ### Show a user
 @app.get(
     path='/users/{user_id}',
@@ -164,13 +739,14 @@ def show_all_users():
     summary="Show a user",
     tags=["Users"]
 )
-def show_a_user(
+async def show_a_user(
     user_id: UUID = Path(
         ...,
         title = "User ID",
         description = "User ID",
         example = "3fa85f64-5717-4562-b3fc-2c963f66afa2",
-        )
+        ),
+    if_none_match: Optional[str] = Header(default=None)
     ):
     """
     Show a User
@@ -179,6 +755,8 @@ def show_a_user(
 
     Parameters:
         - user_id: UUID
+        - Header parameters:
+            - if_none_match: Optional[str]
 
     Returns a json with user data:
         - user_id: UUID
@@ -187,17 +765,17 @@ def show_a_user(
         - last_name: str
         - birth_date: datetime
     """
-    with open("user.json", "r+", encoding="utf-8") as f:
-        results = json.loads(f.read())
-        id = str(user_id)
-    for data in results:
-        if data["user_id"] == id:
-            return data
-    else:
+    data = repository.users.get(str(user_id))
+    if data is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"¡This user_id doesn't exist!"
         )
+    headers = validators((repository.users, data["user_id"]))
+    cached = not_modified(if_none_match, headers)
+    if cached is not None:
+        return cached
+    return json_response(user_json(data), headers)
 ### Delete a user
 @app.delete(
     path='/users/{user_id}',
@@ -206,7 +784,7 @@ def show_a_user(
     summary="Delete a user",
     tags=["Users"]
 )
-def delete_a_user(
+async def delete_a_user(
     user_id: UUID = Path(
         ...,
         title="User ID",
@@ -217,7 +795,8 @@ def delete_a_user(
     """
     Delete a User
 
-    This path operation delete a user in the app
+    This path operation delete a user in the app, with their tweets and
+    follows
 
     Parameters:
         - user_id: UUID
@@ -229,21 +808,14 @@ def delete_a_user(
         - last_name: str
         - birth_date: datetime
     """
-    with open("user.json", "r+", encoding="utf-8") as f:
-        results = json.loads(f.read())
-        id = str(user_id)
-    for data in results:
-        if data["user_id"] == id:
-            results.remove(data)
-            with open("user.json", "w", encoding="utf-8") as f:
-                f.seek(0)
-                f.write(json.dumps(results))
-            return data
-    else:
+    data = await repository.adelete_user(str(user_id))
+    if data is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="¡This user_id doesn't exist!"
         )
+    # Stored as it was written, e.g. with a datetime as birth_date
+    return public(data)
 
 ### Update a user
 @app.put(
@@ -253,7 +825,7 @@ def delete_a_user(
     summary="Update a user",
     tags=["Users"]
 )
-def update_a_user(
+async def update_a_user(
     user_id: UUID = Path(
             ...,
             title="User ID",
@@ -272,29 +844,281 @@ def update_a_user(
     - Request body parameter:
         - **user: User** -> A user model with user_id, email, first name, last name, birth date and password
 
-    Returns a user model with user_id, email, first_name, last_name and birth_date
+    Returns a user model with user_id, email, first_name, last_name and birth_date.
+    409 if the new user_id or email belongs to another user. If the
+    user_id changes, the tweets and follows of the user move with it
     """
     user_id = str(user_id)
-    user_dict = user.dict()
-    user_dict["user_id"] = str(user_dict["user_id"])
-    user_dict["birth_date"] = str(user_dict["birth_date"])
-    with open("user.json", "r+", encoding="utf-8") as f:
-        results = json.loads(f.read())
-    for user in results:
-        if user["user_id"] == user_id:
-            results[results.index(user)] = user_dict
-            with open("user.json", "w", encoding="utf-8") as f:
-                f.seek(0)
-                f.write(json.dumps(results))
-            return user
-    else:
+    password_hash = await run_hasher(hash_password, user.password)
+    data = await repository.areplace_user(user_id, user_record(user, password_hash))
+    if data is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="¡This user_id doesn't exist!"
         )
+    return data
+
+## Follows
+
+### Follow a user
+@app.post(
+    path='/users/{user_id}/following/{followee_id}',
+    response_model=Follow,
+    status_code=status.HTTP_201_CREATED,
+    summary="Follow a user",
+    tags=["Follows"]
+)
+async def follow(
+    user_id: UUID = Path(
+        ...,
+        title="User ID",
+        description="This is the ID of the follower",
+        example="3fa85f64-5717-4562-b3fc-2c963f66afa6"
+    ),
+    followee_id: UUID = Path(
+        ...,
+        title="Followee ID",
+        description="This is the ID of the user to follow",
+        example="3fa85f64-5717-4562-b3fc-2c963f66afa7"
+    )
+):
+    """
+    Follow
+
+    This path operation makes a user follow another one, whose tweets
+    show up in their timeline from now on
+
+    Parameters:
+        - user_id: UUID
+        - followee_id: UUID
+
+    Returns a json with the follow:
+        - follower_id: UUID
+        - followee_id: UUID
+        - created_at: datetime
+    """
+    user_id, followee_id = str(user_id), str(followee_id)
+    if user_id == followee_id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="¡A user can't follow themselves!"
+        )
+    if repository.users.get(user_id) is None or repository.users.get(followee_id) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="¡This user_id doesn't exist!"
+        )
+    key = follow_id(user_id, followee_id)
+    existing = repository.follows.get(key)
+    if existing is not None:
+        return existing
+    try:
+        return await repository.follows.ainsert({
+            "follow_id": key,
+            "follower_id": user_id,
+            "followee_id": followee_id,
+            "created_at": str(datetime.now())
+        })
+    except Conflict:
+        # Followed by a concurrent request
+        return repository.follows.get(key)
+
+### Unfollow a user
+@app.delete(
+    path='/users/{user_id}/following/{followee_id}',
+    response_model=Follow,
+    status_code=status.HTTP_200_OK,
+    summary="Unfollow a user",
+    tags=["Follows"]
+)
+async def unfollow(
+    user_id: UUID = Path(
+        ...,
+        title="User ID",
+        description="This is the ID of the follower",
+        example="3fa85f64-5717-4562-b3fc-2c963f66afa6"
+    ),
+    followee_id: UUID = Path(
+        ...,
+        title="Followee ID",
+        description="This is the ID of the followed user",
+        example="3fa85f64-5717-4562-b3fc-2c963f66afa7"
+    )
+):
+    """
+    Unfollow
+
+    This path operation makes a user stop following another one
+
+    Parameters:
+        - user_id: UUID
+        - followee_id: UUID
+
+    Returns a json with the deleted follow:
+        - follower_id: UUID
+        - followee_id: UUID
+        - created_at: datetime
+    """
+    data = await repository.follows.adelete(follow_id(str(user_id), str(followee_id)))
+    if data is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="¡This user doesn't follow that user!"
+        )
+    return data
+
+### Show a timeline
+@app.get(
+    path='/users/{user_id}/timeline',
+    response_model=List[Tweets],
+    status_code=status.HTTP_200_OK,
+    summary="Show the home timeline of a user",
+    tags=["Follows"]
+)
+async def timeline(
+    user_id: UUID = Path(
+        ...,
+        title="User ID",
+        description="This is the user ID",
+        example="3fa85f64-5717-4562-b3fc-2c963f66afa6"
+    ),
+    limit: int = Query(
+        default=PAGE_SIZE,
+        ge=1,
+        le=MAX_PAGE_SIZE,
+        title="Page size",
+        description="Maximum number of tweets in the page"
+    ),
+    cursor: Optional[str] = Query(
+        default=None,
+        title="Cursor",
+        description="X-Next-Cursor header of the previous page"
+    ),
+    accept_encoding: Optional[str] = Header(default=None)
+):
+    """
+    Timeline
+
+    This path operation shows the tweets of the users a user follows,
+    and their own, newest first, one page at a time
+
+    Parameters:
+        - user_id: UUID
+        - Query parameters:
+            - limit: int
+            - cursor: Optional[str]
+        - Header parameters:
+            - accept_encoding: Optional[str]
+
+    Returns a json list of tweets:
+
+        - tweet_id: UUID
+        - content: str
+        - created_at: datetime
+        - updated_at: Optional[datetime]
+        - by: User
+
+    The cursor of the next page comes in the X-Next-Cursor header
+    """
+    user_id = str(user_id)
+    if repository.users.get(user_id) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="¡This user_id doesn't exist!"
+        )
+    try:
+        keys, next_entry = repository.timelines.page(
+            user_id, limit, decode_cursor(cursor) if cursor else None
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="¡This cursor is not valid!"
+        )
+    tweets = repository.tweets.records(keys)
+    return json_list(
+        map(tweet_json, tweets),
+        encode_cursor(next_entry) if next_entry is not None else None,
+        accept_encoding=accept_encoding
+    )
 
 ## Tweets
 
+### Show the tweets of a user
+@app.get(
+    path='/users/{user_id}/tweets',
+    response_model=List[Tweets],
+    status_code=status.HTTP_200_OK,
+    summary="Show the tweets of a user",
+    tags=["Tweets"]
+)
+async def user_tweets(
+    user_id: UUID = Path(
+        ...,
+        title="User ID",
+        description="This is the user ID",
+        example="3fa85f64-5717-4562-b3fc-2c963f66afa6"
+    ),
+    limit: int = Query(
+        default=PAGE_SIZE,
+        ge=1,
+        le=MAX_PAGE_SIZE,
+        title="Page size",
+        description="Maximum number of tweets in the page"
+    ),
+    cursor: Optional[str] = Query(
+        default=None,
+        title="Cursor",
+        description="X-Next-Cursor header of the previous page"
+    ),
+    accept_encoding: Optional[str] = Header(default=None)
+):
+    """
+    User Tweets
+
+    This path operation shows the tweets of a user, newest first, one
+    page at a time, from the author index
+
+    Parameters:
+        - user_id: UUID
+        - Query parameters:
+            - limit: int
+            - cursor: Optional[str]
+        - Header parameters:
+            - accept_encoding: Optional[str]
+
+    Returns a json list of tweets:
+
+        - tweet_id: UUID
+        - content: str
+        - created_at: datetime
+        - updated_at: Optional[datetime]
+        - by: User
+
+    The cursor of the next page comes in the X-Next-Cursor header
+    """
+    user_id = str(user_id)
+    if repository.users.get(user_id) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="¡This user_id doesn't exist!"
+        )
+    try:
+        keys, next_entry = repository.tweets_by_author.page(
+            user_id, limit, decode_cursor(cursor) if cursor else None
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="¡This cursor is not valid!"
+        )
+    tweets = repository.tweets.records(keys)
+    return json_list(
+        map(tweet_json, tweets),
+        encode_cursor(next_entry) if next_entry is not None else None,
+        accept_encoding=accept_encoding
+    )
+
 ### Post a tweet
 @app.post(
     path='/post',
@@ -303,13 +1127,18 @@ def update_a_user(
     summary="Post a tweet",
     tags=["Tweets"]
 )
-def post(tweet: Tweets = Body(...)):
+async def post(
+    tweet: Tweets = Body(...),
+    idempotency_key: Optional[str] = Header(default=None, max_length=255)
+):
     """
     Post a Tweet
     This path operation post a tweet in the app
     Parameters:
         - Request body parameter
             - tweet: Tweets
+        - Header parameters
+            - idempotency_key: Optional[str]
 
     Returns a json with the basic tweet information:
 
@@ -318,20 +1147,162 @@ def post(tweet: Tweets = Body(...)):
         - created_at: datetime
         - updated_at: Optional[datetime]
         - by: User
+
+    409 if the tweet_id is taken. A retry with the same Idempotency-Key
+    gets the first response instead
+    """
+    async def publish():
+        tweet_dict = tweet_record(tweet)
+        if repository.users.get(tweet_dict["author_id"]) is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="¡This user_id doesn't exist!"
+            )
+        return repository.join(await repository.tweets.ainsert(tweet_dict))
+    return await idempotent("/post", idempotency_key, tweet, publish)
+
+### Post many tweets
+@app.post(
+    path='/tweets/bulk',
+    response_model=TweetsBulkOut,
+    status_code=status.HTTP_201_CREATED,
+    summary="Post many tweets",
+    tags=["Tweets"]
+)
+async def post_bulk(tweets: conlist(Tweets, min_items=1, max_items=BULK_SIZE) = Body(...)):
+    """
+    Post Bulk
+    This path operation posts up to 1000 tweets with a single write
+    Parameters:
+        - Request body parameter
+            - tweets: List[Tweets]
+
+    Returns a json with the posted tweets and the tweets that were not
+    posted, with the reason:
+
+        - tweets: List[Tweets]
+        - errors: List[BulkError]
+    """
+    records = []
+    errors = []
+    for tweet in tweets:
+        tweet_dict = tweet_record(tweet)
+        if repository.users.get(tweet_dict["author_id"]) is None:
+            errors.append(BulkError(id=tweet_dict["tweet_id"], detail="¡This user_id doesn't exist!"))
+        else:
+            records.append(tweet_dict)
+    posted = []
+    results = await repository.tweets.ainsert_many(records) if records else []
+    for tweet_dict, result in zip(records, results):
+        if isinstance(result, Conflict):
+            errors.append(BulkError(id=tweet_dict["tweet_id"], detail=conflict_detail(result)))
+        else:
+            posted.append(result)
+    return TweetsBulkOut(
+        tweets=[tweet for tweet in map(repository.join, posted) if tweet is not None],
+        errors=errors
+    )
+
+### Show many tweets
+@app.get(
+    path='/tweets',
+    response_model=Union[TweetsBulkOut,List[Tweets]],
+    status_code=status.HTTP_200_OK,
+    summary="Show many tweets",
+    tags=["Tweets"]
+)
+async def show_tweets(
+    ids: Optional[List[str]] = Query(
+        default=None,
+        title="Tweet IDs",
+        description="IDs of the tweets, comma separated or repeated",
+        example=["3fa85f64-5717-4562-b3fc-2c963f66afa6"]
+    ),
+    since: Optional[datetime] = Query(
+        default=None,
+        title="Since",
+        description="Only tweets created at or after this time"
+    ),
+    until: Optional[datetime] = Query(
+        default=None,
+        title="Until",
+        description="Only tweets created before this time"
+    ),
+    limit: int = Query(
+        default=PAGE_SIZE,
+        ge=1,
+        le=MAX_PAGE_SIZE,
+        title="Page size",
+        description="Maximum number of tweets in the page"
+    ),
+    cursor: Optional[str] = Query(
+        default=None,
+        title="Cursor",
+        description="X-Next-Cursor header of the previous page"
+    ),
+    accept: Optional[str] = Header(default=None),
+    accept_encoding: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None)
+):
     """
-    with open("tweets.json", "r+", encoding="utf-8") as f:
-        results = json.loads(f.read())
-        tweet_dict = tweet.dict()
-        tweet_dict["tweet_id"] = str(tweet_dict["tweet_id"])
-        tweet_dict["created_at"] = str(tweet_dict["created_at"])
-        tweet_dict["updated_at"] = str(tweet_dict["updated_at"])
-        tweet_dict["by"]["user_id"] = str(tweet_dict["by"]["user_id"])
-        tweet_dict["by"]["birth_date"] = str(tweet_dict["by"]["birth_date"])
-
-        results.append(tweet_dict)
-        f.seek(0)
-        f.write(json.dumps(results))
-        return tweet
+    Show Tweets
+
+    This path operation shows many tweets in one round trip: the ones
+    with the given ids, or the ones created in a time window
+
+    Parameters:
+        - Query parameters:
+            - ids: Optional[List[str]]
+            - since: Optional[datetime]
+            - until: Optional[datetime]
+            - limit: int
+            - cursor: Optional[str]
+        - Header parameters:
+            - accept: Optional[str]
+            - accept_encoding: Optional[str]
+            - if_none_match: Optional[str]
+
+    With ids, returns a json with the tweets found, in the requested
+    order, and an error for every id that was not found:
+
+        - tweets: List[Tweets]
+        - errors: List[BulkError]
+
+    Otherwise returns the tweets created since `since` (included) and
+    until `until` (excluded), newest first, one page at a time, like the
+    home page. The cursor of the next page comes in the X-Next-Cursor
+    header
+    """
+    if ids is None:
+        return tweets_between(since, until, limit, cursor, accept, accept_encoding, if_none_match)
+    if since is not None or until is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="¡ids can't be combined with since or until!"
+        )
+    ids = [id.strip() for value in ids for id in value.split(",") if id.strip()]
+    if len(ids) > BULK_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"¡No more than {BULK_SIZE} ids at a time!"
+        )
+    tweets = []
+    errors = []
+    for id in ids:
+        try:
+            key = str(UUID(id))
+        except ValueError:
+            errors.append(BulkError(id=id, detail="¡This is not a valid tweet_id!"))
+            continue
+        tweet = repository.tweets.get(key)
+        data = tweet_json(tweet) if tweet is not None else None
+        if data is None:
+            errors.append(BulkError(id=id, detail="¡This tweet_id doesn't exist!"))
+        else:
+            tweets.append(data)
+    errors = json_array(error.json(separators=SEPARATORS).encode() for error in errors)
+    return json_response(b'{"tweets":' + json_array(tweets) + b',"errors":' + errors + b"}")
+
 ### Show all Tweets
 @app.get(
     path='/',
@@ -340,13 +1311,35 @@ def post(tweet: Tweets = Body(...)):
     summary="Show all tweets",
     tags=["Tweets"]
 )
-def home():
+async def home(
+    limit: int = Query(
+        default=PAGE_SIZE,
+        ge=1,
+        le=MAX_PAGE_SIZE,
+        title="Page size",
+        description="Maximum number of tweets in the page"
+    ),
+    cursor: Optional[str] = Query(
+        default=None,
+        title="Cursor",
+        description="X-Next-Cursor header of the previous page"
+    ),
+    accept: Optional[str] = Header(default=None),
+    accept_encoding: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None)
+):
     """
     Post a Tweet
-    This path operation shows all tweets in the app
+    This path operation shows all tweets in the app, newest first, one page at a time
 
     Parameters:
-        -
+        - Query parameters:
+            - limit: int
+            - cursor: Optional[str]
+        - Header parameters:
+            - accept: Optional[str]
+            - accept_encoding: Optional[str]
+            - if_none_match: Optional[str]
 
     Returns a json with the basic tweet information:
 
@@ -355,10 +1348,93 @@ def home():
         - created_at: datetime
         - updated_at: Optional[datetime]
         - by: User
+
+    The cursor of the next page comes in the X-Next-Cursor header.
+    With "Accept: application/x-ndjson" every tweet is streamed instead,
+    one json per line
     """
-    with open("tweets.json","r",encoding="utf-8") as f:
-        results = json.loads(f.read())
-        return results
+    if wants_ndjson(accept):
+        return ndjson(repository.tweets, repository.tweets_by_date, tweet_json, descending=True)
+    headers = validators((repository.tweets, None), (repository.users, None), limit, cursor)
+    cached = not_modified(if_none_match, headers) or cached_page(headers, accept_encoding)
+    if cached is not None:
+        return cached
+    tweets, next_cursor = paginate(repository.tweets, repository.tweets_by_date, limit, cursor, descending=True)
+    return json_list(map(tweet_json, tweets), next_cursor, headers, accept_encoding)
+
+### Search tweets
+@app.get(
+    path='/tweets/search',
+    response_model=List[Tweets],
+    status_code=status.HTTP_200_OK,
+    summary="Search tweets",
+    tags=["Tweets"]
+)
+async def search_tweets(
+    q: str = Query(
+        ...,
+        min_length=1,
+        max_length=256,
+        title="Query",
+        description="Words the tweets must contain, accents and case don't matter",
+        example="tweet"
+    ),
+    limit: int = Query(
+        default=PAGE_SIZE,
+        ge=1,
+        le=MAX_PAGE_SIZE,
+        title="Page size",
+        description="Maximum number of tweets in the page"
+    ),
+    cursor: Optional[str] = Query(
+        default=None,
+        title="Cursor",
+        description="X-Next-Cursor header of the previous page"
+    ),
+    accept_encoding: Optional[str] = Header(default=None)
+):
+    """
+    Search Tweets
+
+    This path operation finds the tweets containing every word of the
+    query, best matches first, one page at a time
+
+    Parameters:
+        - Query parameters:
+            - q: str
+            - limit: int
+            - cursor: Optional[str]
+        - Header parameters:
+            - accept_encoding: Optional[str]
+
+    Returns a json list of tweets:
+
+        - tweet_id: UUID
+        - content: str
+        - created_at: datetime
+        - updated_at: Optional[datetime]
+        - by: User
+
+    The cursor of the next page comes in the X-Next-Cursor header
+    """
+    if not repository.tweets_by_content.ready.is_set():
+        # Still being built after startup, wait without blocking the loop
+        await to_thread.run_sync(repository.tweets_by_content.build)
+    try:
+        keys, next_entry = repository.tweets_by_content.search(
+            q, limit, decode_cursor(cursor) if cursor else None
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="¡This cursor is not valid!"
+        )
+    tweets = repository.tweets.records(keys)
+    return json_list(
+        map(tweet_json, tweets),
+        encode_cursor(next_entry) if next_entry is not None else None,
+        accept_encoding=accept_encoding
+    )
 
 ### Show a tweet
 @app.get(
@@ -368,25 +1444,29 @@ def home():
     summary="Shows a tweet",
     tags=["Tweets"]
 )
-def show_a_tweet(
+async def show_a_tweet(
     tweet_id: UUID = Path(
     ...,
     title="Tweet ID",
     description="This is the tweet ID",
     example="3fa85f64-5717-4562-b3fc-2c963f66afa6"
-    )
+    ),
+    if_none_match: Optional[str] = Header(default=None)
 ):
-    with open("tweets.json", "r+", encoding="utf-8") as f:
-        results = json.loads(f.read())
-        id = str(tweet_id)
-    for data in results:
-        if data["tweet_id"] == id:
-            return data
-    else:
+    tweet = repository.tweets.get(str(tweet_id))
+    if tweet is None or repository.join(tweet) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"¡This tweet_id doesn't exist!"
         )
+    headers = validators(
+        (repository.tweets, tweet["tweet_id"]),
+        (repository.users, tweet.get("author_id"))
+    )
+    cached = not_modified(if_none_match, headers)
+    if cached is not None:
+        return cached
+    return json_response(tweet_json(tweet), headers)
 
 ### Delete a tweet
 @app.delete(
@@ -396,7 +1476,7 @@ def show_a_tweet(
     summary="Deletes a tweet",
     tags=["Tweets"]
 )
-def delete_a_tweet(
+async def delete_a_tweet(
     tweet_id: UUID = Path(
         ...,
         title="Tweet ID",
@@ -419,21 +1499,7 @@ def delete_a_tweet(
         - updated_at: Optional[datetime]
         - by: User
     """
-    with open("tweets.json", "r+", encoding="utf-8") as f:
-        results = json.loads(f.read())
-        id = str(tweet_id)
-    for data in results:
-        if data["tweet_id"] == id:
-            results.remove(data)
-            with open("tweets.json", "w", encoding="utf-8") as f:
-                f.seek(0)
-                f.write(json.dumps(results))
-            return data
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="¡This tweet_id doesn't exist!"
-        )
+    return written_tweet(await repository.tweets.adelete(str(tweet_id)))
 
 ### Update a tweet
 @app.put(
@@ -443,7 +1509,7 @@ def delete_a_tweet(
     summary="Updates a tweet",
     tags=["Tweets"]
 )
-def update_a_tweet(
+async def update_a_tweet(
     tweet_id: UUID = Path(
             ...,
             title="Tweet ID",
@@ -476,19 +1542,25 @@ def update_a_tweet(
         - by: User
     """
     tweet_id = str(tweet_id)
-    with open("tweets.json", "r+", encoding="utf-8") as f:
-        results = json.loads(f.read())
-    for tweet in results:
-        if tweet["tweet_id"] == tweet_id:
-            tweet['content'] = content
-            tweet['updated_at'] = str(datetime.now())
-            print(tweet)
-            with open("tweets.json", "w", encoding="utf-8") as f:
-                f.seek(0)
-                f.write(json.dumps(results))
-            return tweet
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="¡This tweet_id doesn't exist!"
-        )
+    return written_tweet(await repository.tweets.aupdate(
+        tweet_id,
+        {"content": content, "updated_at": str(datetime.now())}
+    ))
+
+## Metrics
+
+@app.get(
+    path='/metrics',
+    status_code=status.HTTP_200_OK,
+    summary="Metrics in the Prometheus text format",
+    tags=["Metrics"],
+    include_in_schema=False
+)
+async def metrics():
+    """
+    Metrics
+
+    Request latencies, requests in flight and storage I/O, for Prometheus
+    to scrape
+    """
+    return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,259 @@
+# Python
+import time
+import bisect
+import threading
+from typing import Callable,Dict,List,Optional,Tuple
+
+# Latency buckets in seconds, from 100us to 10s
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+def escape(value:str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names:Tuple[str,...], values:Tuple[str,...], extra:str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value:float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """
+    Metric
+
+    One metric family in the Prometheus text format, with a child per
+    combination of label values. Recording is a dict lookup and a few
+    additions under a lock; the text is only built when /metrics is
+    scraped.
+    """
+    kind = ""
+
+    def __init__(self, name:str, help:str, labels:Tuple[str,...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.children: Dict[Tuple[str,...],list] = {}
+
+    def child(self, values:Tuple[str,...]) -> list:
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def new_child(self) -> list:
+        return [0]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self.children.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, values)} {format_value(child[0])}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *values:str, amount:float = 1):
+        child = self.child(values)
+        with self.lock:
+            child[0] += amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name:str, help:str, labels:Tuple[str,...] = (), function:Optional[Callable[[],Dict[Tuple[str,...],float]]] = None):
+        super().__init__(name, help, labels)
+        # Called on scrape for values that are cheaper to read than to track
+        self.function = function
+
+    def inc(self, *values:str, amount:float = 1):
+        child = self.child(values)
+        with self.lock:
+            child[0] += amount
+
+    def dec(self, *values:str, amount:float = 1):
+        self.inc(*values, amount=-amount)
+
+    def render(self) -> List[str]:
+        if self.function is not None:
+            for values, value in self.function().items():
+                self.child(values)[0] = value
+        return super().render()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name:str, help:str, labels:Tuple[str,...] = (), buckets:Tuple[float,...] = BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def new_child(self) -> list:
+        # One count per bucket (not cumulative), then +Inf, sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value:float, *values:str):
+        child = self.child(values)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            child[index] += 1
+            child[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self.children.items()):
+            with self.lock:
+                counts, total = child[:-1], child[-1]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = format_labels(self.labels, values, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric:Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# HTTP
+
+http_requests = registry.counter(
+    "twitter_http_requests_total", "Requests handled", ("method", "route", "status")
+)
+http_request_duration = registry.histogram(
+    "twitter_http_request_duration_seconds", "Time to handle a request, body included", ("method", "route")
+)
+http_in_flight = registry.gauge(
+    "twitter_http_requests_in_flight", "Requests being handled"
+)
+
+# Storage
+
+storage_bytes_read = registry.counter(
+    "twitter_storage_bytes_read_total", "Bytes read from json files, logs and SQLite", ("table",)
+)
+storage_bytes_written = registry.counter(
+    "twitter_storage_bytes_written_total", "Bytes written to json files, logs and SQLite", ("table",)
+)
+storage_json_parse = registry.histogram(
+    "twitter_storage_json_parse_seconds", "Time spent in json.loads per file or log", ("table",)
+)
+storage_commit_duration = registry.histogram(
+    "twitter_storage_commit_seconds", "Time to apply and persist one batch of writes", ("table",)
+)
+storage_batch_size = registry.histogram(
+    "twitter_storage_batch_size", "Mutations per committed batch", ("table",),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+)
+serialize_duration = registry.histogram(
+    "twitter_serialize_seconds", "Time to serialize a record on a cache miss", ("cache",)
+)
+
+# Caches
+
+cache_hits = registry.counter(
+    "twitter_cache_hits_total", "Reads served from a cache", ("cache",)
+)
+cache_misses = registry.counter(
+    "twitter_cache_misses_total", "Reads that had to serialize the record", ("cache",)
+)
+cache_evictions = registry.counter(
+    "twitter_cache_evictions_total", "Entries dropped for being least recently used or expired", ("cache", "reason")
+)
+cache_invalidations = registry.counter(
+    "twitter_cache_invalidations_total", "Entries dropped because their record was written", ("cache",)
+)
+
+class RouteNames:
+    """
+    RouteNames
+
+    Route template of a handled request ("/tweets/{tweet_id}", not the
+    actual path), from the endpoint the router put in the scope
+    """
+    def __init__(self, routes:Callable[[],list]):
+        self.routes = routes
+        # endpoint function -> route path, filled on first use
+        self.paths: Dict[Callable,str] = {}
+
+    def __call__(self, scope:dict) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        path = self.paths.get(endpoint)
+        if path is None:
+            for route in self.routes():
+                if getattr(route, "endpoint", None) is endpoint:
+                    path = route.path
+                    break
+            else:
+                path = "unmatched"
+            self.paths[endpoint] = path
+        return path
+
+class MetricsMiddleware:
+    """
+    MetricsMiddleware
+
+    ASGI middleware that times every http request and counts it by
+    method, route template (so the number of series stays bounded) and
+    status code.
+    """
+    def __init__(self, app, routes:Callable[[],list]):
+        self.app = app
+        self.route = RouteNames(routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_in_flight.dec()
+            method = scope["method"]
+            route = self.route(scope)
+            http_request_duration.observe(elapsed, method, route)
+            http_requests.inc(method, route, str(status))
@@ -0,0 +1,75 @@
+# Python
+import os
+import asyncio
+import hmac
+import base64
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+SCRYPT_N = int(os.environ.get("TWITTER_SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = 8
+SCRYPT_P = 1
+HASH_WORKERS = int(os.environ.get("TWITTER_HASH_WORKERS", str(os.cpu_count() or 1)))
+
+# Bounded pool for hashing: scrypt takes ~16MB and tens of ms per call, so
+# a login burst queues here instead of starving the request threads
+hasher = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hasher")
+
+async def run_hasher(function, *args):
+    """
+    Runs hash_password or verify_password in the hasher pool
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(hasher, function, *args)
+
+def _b64(data:bytes) -> str:
+    return base64.b64encode(data).decode()
+
+def hash_password(password:str) -> str:
+    """
+    Returns a salted scrypt hash as "scrypt$n$r$p$salt$hash"
+    """
+    salt = os.urandom(16)
+    digest = hashlib.scrypt(
+        password.encode(),
+        salt=salt,
+        n=SCRYPT_N,
+        r=SCRYPT_R,
+        p=SCRYPT_P,
+        maxmem=256 * SCRYPT_N * SCRYPT_R
+    )
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+
+@functools.lru_cache(maxsize=None)
+def dummy_hash() -> str:
+    """
+    Hash of a random password, verified against when there is no real
+    one, so that takes as long as checking a real password
+    """
+    return hash_password(_b64(os.urandom(16)))
+
+def is_hashed(stored:str) -> bool:
+    return stored.startswith("scrypt$")
+
+def verify_password(password:str, stored:str) -> bool:
+    """
+    Checks a password against a stored hash. Plaintext passwords written
+    before hashing was introduced are still accepted
+    """
+    if not is_hashed(stored):
+        # As slow as a hashed one
+        verify_password(password, dummy_hash())
+        return hmac.compare_digest(password.encode(), stored.encode())
+    _, n, r, p, salt, digest = stored.split("$")
+    expected = base64.b64decode(digest)
+    actual = hashlib.scrypt(
+        password.encode(),
+        salt=base64.b64decode(salt),
+        n=int(n),
+        r=int(r),
+        p=int(p),
+        maxmem=256 * int(n) * int(r),
+        dklen=len(expected)
+    )
+    return hmac.compare_digest(actual, expected)
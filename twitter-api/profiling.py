@@ -0,0 +1,136 @@
+# Python
+import os
+import re
+import time
+import pstats
+import asyncio
+import cProfile
+import itertools
+from datetime import datetime
+from typing import Callable,Dict,List,Optional,Tuple
+# Metrics
+from metrics import RouteNames
+
+# Requests carrying "X-Profile: <token>" are profiled. Unset disables the header
+PROFILE_TOKEN = os.environ.get("TWITTER_PROFILE_TOKEN", "")
+# Profile one request in N, 0 disables sampling
+PROFILE_SAMPLE = int(os.environ.get("TWITTER_PROFILE_SAMPLE", "0"))
+PROFILE_DIR = os.environ.get("TWITTER_PROFILE_DIR", "profiles")
+PROFILE_HEADER = b"x-profile"
+
+def enabled() -> bool:
+    return bool(PROFILE_TOKEN) or PROFILE_SAMPLE > 0
+
+def label(function:tuple) -> str:
+    filename, line, name = function
+    if filename == "~":
+        # Builtins: ('~', 0, "<built-in method time.sleep>")
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+def collapsed_stacks(stats:pstats.Stats, max_depth:int = 64) -> List[str]:
+    """
+    Profile in the collapsed stack format of flamegraph.pl and speedscope,
+    "root;caller;callee <microseconds>" per line.
+
+    cProfile only keeps caller -> callee edges, not whole stacks, so the
+    time of a function reached through several paths is split between
+    them in proportion to each edge's cumulative time.
+    """
+    callees: Dict[tuple,List[Tuple[tuple,float]]] = {}
+    roots = []
+    for function, (_, _, _, cumulative, callers) in stats.stats.items():
+        if not callers:
+            roots.append(function)
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((function, edge[3]))
+    totals: Dict[str,float] = {}
+
+    def walk(function:tuple, spent:float, path:Tuple[tuple,...]):
+        _, _, own, cumulative, _ = stats.stats[function]
+        share = spent / cumulative if cumulative else 0.0
+        path = path + (function,)
+        stack = ";".join(label(f) for f in path)
+        totals[stack] = totals.get(stack, 0.0) + own * share
+        if len(path) >= max_depth:
+            return
+        for callee, edge in callees.get(function, ()):
+            if callee not in path:
+                walk(callee, edge * share, path)
+
+    for root in roots:
+        walk(root, stats.stats[root][3], ())
+    return [
+        f"{stack} {round(seconds * 1e6)}"
+        for stack, seconds in totals.items()
+        if seconds * 1e6 >= 1
+    ]
+
+class ProfilingMiddleware:
+    """
+    ProfilingMiddleware
+
+    Runs cProfile around one request when it carries the profile header
+    with the right token, or when it is the Nth request with sampling on.
+    Writes <route>-<ms>ms-<time>.prof (for pstats or snakeviz) and a
+    .folded file of collapsed stacks (for flamegraphs) to PROFILE_DIR.
+
+    Only one request is profiled at a time. Other requests running on the
+    event loop meanwhile show up in the profile, and work done by the
+    writer thread doesn't.
+    """
+    def __init__(
+        self,
+        app,
+        routes:Callable[[],list],
+        token:str = PROFILE_TOKEN,
+        sample:int = PROFILE_SAMPLE,
+        directory:str = PROFILE_DIR
+    ):
+        self.app = app
+        self.route = RouteNames(routes)
+        self.token = token.encode()
+        self.sample = sample
+        self.directory = directory
+        self.requests = itertools.count(1)
+        self.active = False
+
+    def wanted(self, scope:dict) -> bool:
+        if self.sample and next(self.requests) % self.sample == 0:
+            return True
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    return value == self.token
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.active or not self.wanted(scope):
+            await self.app(scope, receive, send)
+            return
+        self.active = True
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            self.active = False
+            name = self.filename(scope, elapsed)
+            await asyncio.get_running_loop().run_in_executor(None, self.write, profile, name)
+
+    def filename(self, scope:dict, elapsed:float) -> str:
+        route = re.sub(r"[^A-Za-z0-9]+", "_", self.route(scope)).strip("_") or "root"
+        moment = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        return f"{scope['method']}_{route}-{elapsed * 1e3:.0f}ms-{moment}"
+
+    def write(self, profile:cProfile.Profile, name:str) -> Optional[str]:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        stats = pstats.Stats(profile)
+        stats.dump_stats(path + ".prof")
+        with open(path + ".folded", "w", encoding="utf-8") as f:
+            f.write("\n".join(collapsed_stacks(stats)) + "\n")
+        return path
@@ -0,0 +1,180 @@
+# Python
+import re
+import math
+import heapq
+import threading
+import unicodedata
+from typing import Callable,Dict,List,Optional,Tuple
+
+TOKEN = re.compile(r"\w+")
+
+# Words too common in Spanish (and English) tweets to be worth indexing
+STOPWORDS = frozenset("""
+a al algo con de del el ella en es esta este esto la las le lo los mas me mi
+muy no o para pero por que se si sin su sus te tu un una uno y ya yo
+an and are as at be by for from in is it of on or the this to was with
+""".split())
+
+def fold(text:str) -> str:
+    """
+    Lowercase without accents: "Canción" -> "cancion"
+    """
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def tokenize(text:str) -> List[str]:
+    return [token for token in TOKEN.findall(fold(text)) if token not in STOPWORDS]
+
+class SearchIndex:
+    """
+    SearchIndex
+
+    Inverted index over one text field of a table: token -> {key: term
+    frequency}. Registered as a table index, so it is updated on every
+    write. Queries return the keys that contain every token, ranked by
+    BM25.
+
+    With `background` rebuild() only takes the rows and build() indexes
+    them, on another thread, so loading the table doesn't wait for it.
+    Writes meanwhile note their keys, and build() indexes those records
+    again at the end. Searches wait for build()
+    """
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, text:Callable[[dict],str], background:bool = False):
+        self.text = text
+        self.postings: Dict[str,Dict[str,int]] = {}
+        # key -> distinct tokens of the record, to remove it on writes
+        self.terms: Dict[str,Tuple[str,...]] = {}
+        self.lengths: Dict[str,int] = {}
+        self.total_length = 0
+        self.background = background
+        # Rows to build() from, and the keys written since they were taken
+        self.pending: Optional[Dict[str,dict]] = None
+        self.dirty: Optional[set] = None
+        self.lock = threading.Lock()
+        # One build() at a time
+        self.building = threading.Lock()
+        self.ready = threading.Event()
+        self.ready.set()
+
+    def rebuild(self, rows:Dict[str,dict]):
+        if self.background:
+            with self.lock:
+                self.pending = rows
+                self.dirty = set()
+                self.ready.clear()
+            return
+        self.postings = {}
+        self.terms = {}
+        self.lengths = {}
+        self.total_length = 0
+        for key, record in rows.items():
+            self.add(key, record)
+
+    def build(self):
+        """
+        Indexes the rows of the last rebuild(), if that isn't done yet
+        """
+        with self.building:
+            while True:
+                with self.lock:
+                    rows, dirty = self.pending, self.dirty
+                if rows is None:
+                    return
+                # A copy, the table is written meanwhile
+                index = SearchIndex(self.text)
+                index.rebuild(rows.copy())
+                with self.lock:
+                    if self.dirty is not dirty:
+                        # rebuild() again meanwhile
+                        continue
+                    for key in dirty:
+                        index.remove(key)
+                        record = rows.get(key)
+                        if record is not None:
+                            index.add(key, record)
+                    self.postings = index.postings
+                    self.terms = index.terms
+                    self.lengths = index.lengths
+                    self.total_length = index.total_length
+                    self.pending = self.dirty = None
+                    self.ready.set()
+                    return
+
+    def noted(self, key:str) -> bool:
+        """
+        Notes a write while build() runs, False once it is done
+        """
+        with self.lock:
+            if self.dirty is None:
+                return False
+            self.dirty.add(key)
+            return True
+
+    def add(self, key:str, record:dict):
+        if self.dirty is not None and self.noted(key):
+            return
+        self.remove(key)
+        tokens = tokenize(self.text(record) or "")
+        for token in tokens:
+            posting = self.postings.setdefault(token, {})
+            posting[key] = posting.get(key, 0) + 1
+        self.terms[key] = tuple(set(tokens))
+        self.lengths[key] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, key:str):
+        if self.dirty is not None and self.noted(key):
+            return
+        terms = self.terms.pop(key, None)
+        if terms is None:
+            return
+        self.total_length -= self.lengths.pop(key)
+        for token in terms:
+            posting = self.postings[token]
+            del posting[key]
+            if not posting:
+                del self.postings[token]
+
+    def search(self, query:str, limit:int, cursor:Optional[tuple] = None) -> Tuple[List[str],Optional[tuple]]:
+        """
+        Keys of one page of results, best first, and the cursor of the
+        next page (None on the last one)
+        """
+        if not self.ready.is_set():
+            self.build()
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens or not self.lengths:
+            return [], None
+        postings = [self.postings.get(token) for token in tokens]
+        if not all(postings):
+            return [], None
+        postings.sort(key=len)
+        documents = len(self.lengths)
+        if not documents:
+            return [], None
+        average = self.total_length / documents or 1
+        idf = [
+            math.log(1 + (documents - len(posting) + 0.5) / (len(posting) + 0.5))
+            for posting in postings
+        ]
+        results = []
+        # The Writer changes the postings meanwhile: every value is read
+        # once, and a key removed since it was listed is skipped
+        for key in list(postings[0]):
+            frequencies = [posting.get(key) for posting in postings]
+            length = self.lengths.get(key)
+            if None in frequencies or length is None:
+                continue
+            norm = self.K1 * (1 - self.B + self.B * length / average)
+            score = 0.0
+            for weight, frequency in zip(idf, frequencies):
+                score += weight * frequency * (self.K1 + 1) / (frequency + norm)
+            entry = (round(score, 6), key)
+            if cursor is None or entry < cursor:
+                results.append(entry)
+        page = heapq.nlargest(limit + 1, results)
+        next_cursor = page[limit - 1] if len(page) > limit else None
+        return [key for _, key in page[:limit]], next_cursor
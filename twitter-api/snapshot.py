@@ -0,0 +1,648 @@
+"""
+Binary snapshots
+
+A table on disk as fixed-width rows sorted by key, read through mmap:
+
+    header     magic, version, row count, row size, offsets of the parts
+    schema     json list of [field, type]
+    rows       per row: present bitmap (u64), null bitmap (u64), then per
+               field a 16-byte UUID, an int64 timestamp (microseconds since
+               1970-01-01, naive like the stored strings) or an
+               (offset u64, length u32) reference into the heap
+    heap       utf-8 strings and json values, back to back
+    indexes    json directory of the stored indexes, then their arrays
+
+Opening a snapshot reads nothing but the header and the index
+directory. The keys are decoded on the first lookup and a record the
+first time it is read. Field types are inferred when writing and only
+used when a value round-trips exactly (str(UUID(v)) == v and
+str(datetime.fromisoformat(v)) == v), so decoded records are equal to
+the ones written.
+
+An index is stored as its entries, (sort key, key) in index order, cut
+into groups for a GroupIndex: the row number of each key (u32) and the
+sort keys, as float64 or as u32 codes into a list of their distinct
+values (strings). Indexes whose sort keys are something else aren't
+stored.
+"""
+# Python
+import os
+import json
+import mmap
+import bisect
+import sys
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from datetime import datetime,timedelta
+from typing import Dict,Iterable,Iterator,List,Optional,Tuple
+
+MAGIC = b"TWSNAP01"
+VERSION = 2
+# magic, version, field count, row count, row size, schema offset,
+# schema length, rows offset, heap offset, index directory offset,
+# index directory length
+HEADER = struct.Struct("<8sIIQQQQQQQQ")
+# Version 1 snapshots, read without stored indexes
+HEADER_V1 = struct.Struct("<8sIIQQQQQQ")
+EPOCH = datetime(1970, 1, 1)
+MAX_FIELDS = 64
+
+UUID = "uuid"
+TIME = "time"
+STR = "str"
+JSON = "json"
+FORMATS = {UUID: "16s", TIME: "q", STR: "QI", JSON: "QI"}
+# Column value of a row that doesn't have the field
+MISSING = object()
+
+def uuid_bytes(value) -> Optional[bytes]:
+    """
+    The 16 bytes of a canonical (lowercase, dashed) UUID string, None for
+    anything else
+    """
+    if not isinstance(value, str) or len(value) != 36:
+        return None
+    try:
+        raw = bytes.fromhex(value.replace("-", ""))
+    except ValueError:
+        return None
+    return raw if len(raw) == 16 and format_uuid(raw) == value else None
+
+def format_uuid(raw:bytes) -> str:
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+# Position of each hex digit of a UUID in its text, the rest are dashes
+UUID_DIGITS = [i for i in range(36) if i not in (8, 13, 18, 23)]
+
+def format_uuids(raw:bytes) -> List[str]:
+    """
+    format_uuid() of UUIDs stored back to back: the hex digits of all of
+    them are copied into place with one strided slice per digit, which
+    is several times faster than formatting them one by one
+    """
+    count = len(raw) // 16
+    if not count:
+        return []
+    digits = raw.hex().encode()
+    text = bytearray(b"-" * (37 * count))
+    for digit, position in enumerate(UUID_DIGITS):
+        text[position::37] = digits[digit::32]
+    text[36::37] = b"\n" * count
+    return text.decode().split("\n")[:-1]
+
+def time_micros(value) -> Optional[int]:
+    """
+    Microseconds since 1970 of a str(datetime), None for anything else
+    """
+    if not isinstance(value, str) or len(value) < 19:
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if moment.tzinfo is not None or str(moment) != value:
+        return None
+    delta = moment - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+def format_time(micros:int) -> str:
+    return str(EPOCH + timedelta(microseconds=micros))
+
+def pack_array(typecode:str, values:Iterable) -> bytes:
+    values = array(typecode, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+def unpack_array(typecode:str, data) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+def pack_index(rows:Dict[str,int], groups:Optional[List[tuple]], entries:List[tuple]) -> Optional[Tuple[dict,bytes]]:
+    """
+    The directory entry and the arrays of an index (see the module
+    docstring), None if it can't be stored
+    """
+    values = [value for value, _ in entries]
+    try:
+        numbers = pack_array("I", [rows[key] for _, key in entries])
+    except KeyError:
+        # Not an index of these rows
+        return None
+    if all(type(value) is float for value in values):
+        meta = {"sort": "float"}
+        data = pack_array("d", values)
+    elif all(type(value) is str for value in values):
+        distinct = list(dict.fromkeys(values))
+        codes = {value: code for code, value in enumerate(distinct)}
+        meta = {"sort": "code", "values": distinct}
+        data = pack_array("I", [codes[value] for value in values])
+    else:
+        return None
+    if groups is not None:
+        if not all(value is None or type(value) in (str, int) for value, _ in groups):
+            return None
+        meta["groups"] = [list(group) for group in groups]
+    meta["count"] = len(entries)
+    return meta, numbers + data
+
+def infer_schema(records:Iterable[dict], schema:Optional[List[Tuple[str,str]]] = None) -> List[Tuple[str,str]]:
+    """
+    The narrowest type of each field that fits every value: uuid, time,
+    str or json. Widens `schema` if given
+    """
+    types: Dict[str,str] = OrderedDict(schema or ())
+    for record in records:
+        for field, value in record.items():
+            current = types.get(field, UUID)
+            if value is None or current == JSON:
+                types.setdefault(field, current)
+                continue
+            if not isinstance(value, str):
+                current = JSON
+            elif current == UUID and uuid_bytes(value) is None:
+                current = TIME
+            if current == TIME and time_micros(value) is None:
+                current = STR
+            types[field] = current
+    if len(types) > MAX_FIELDS:
+        raise ValueError(f"Snapshots support up to {MAX_FIELDS} fields")
+    return list(types.items())
+
+def write(
+    path:str,
+    records:Iterable[dict],
+    key:str,
+    schema:List[Tuple[str,str]],
+    indexes:Optional[Dict[str,tuple]] = None
+):
+    """
+    Writes `records`, already sorted by key and all fitting `schema`, to
+    `path` (through a temporary file, so readers never see half of it).
+
+    `indexes` are stored with them, by name: (groups, entries) with
+    groups None or a list of (group value, entry count)
+    """
+    fields = [field for field, _ in schema]
+    row = struct.Struct("<QQ" + "".join(FORMATS[kind] for _, kind in schema))
+    schema_data = json.dumps(schema).encode()
+    rows_offset = HEADER.size + len(schema_data)
+    heap = bytearray()
+    keys = []
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"\0" * rows_offset)
+        out = bytearray()
+        for record in records:
+            present = null = 0
+            values = []
+            for bit, (field, kind) in enumerate(schema):
+                value = record.get(field)
+                if field in record:
+                    present |= 1 << bit
+                if value is None:
+                    null |= 1 << bit
+                    if kind == UUID:
+                        values.append(b"")
+                    elif kind == TIME:
+                        values.append(0)
+                    else:
+                        values.extend((0, 0))
+                elif kind == UUID:
+                    values.append(uuid_bytes(value))
+                elif kind == TIME:
+                    values.append(time_micros(value))
+                else:
+                    data = (value if kind == STR else json.dumps(value)).encode()
+                    values.extend((len(heap), len(data)))
+                    heap += data
+            if len(record) != bin(present).count("1"):
+                extra = set(record) - set(fields)
+                raise ValueError(f"Fields {extra} are not in the schema")
+            out += row.pack(present, null, *values)
+            keys.append(record[key])
+            if len(out) >= 1 << 20:
+                f.write(out)
+                out = bytearray()
+        f.write(out)
+        heap_offset = rows_offset + len(keys) * row.size
+        f.write(heap)
+        directory = {}
+        data_offset = heap_offset + len(heap)
+        if indexes:
+            rows = {record_key: i for i, record_key in enumerate(keys)}
+            for name, (groups, entries) in indexes.items():
+                packed = pack_index(rows, groups, entries)
+                if packed is None:
+                    # Noted, so compaction doesn't keep trying
+                    directory[name] = None
+                    continue
+                meta, data = packed
+                meta["offset"] = data_offset
+                directory[name] = meta
+                f.write(data)
+                data_offset += len(data)
+        directory_data = json.dumps(directory).encode()
+        f.write(directory_data)
+        f.seek(0)
+        f.write(HEADER.pack(
+            MAGIC, VERSION, len(schema), len(keys), row.size,
+            HEADER.size, len(schema_data), rows_offset, heap_offset,
+            data_offset, len(directory_data)
+        ))
+        f.write(schema_data)
+    os.replace(tmp, path)
+
+class Snapshot:
+    """
+    Snapshot
+
+    A snapshot file mapped in memory. Rows are looked up by key with a
+    binary search and decoded on demand
+    """
+    def __init__(self, path:str, key:str):
+        self.path = path
+        self.key = key
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        if len(self.map) < HEADER_V1.size:
+            raise ValueError(f"{path} is not a snapshot")
+        magic, version = HEADER_V1.unpack_from(self.map, 0)[:2]
+        if magic != MAGIC or version not in (1, VERSION):
+            raise ValueError(f"{path} is not a version {VERSION} snapshot")
+        # Directory of the stored indexes, see index()
+        self.indexes: Dict[str,dict] = {}
+        if version == 1:
+            (
+                _, _, _, self.count, self.row_size,
+                schema_offset, schema_length, self.rows_offset, self.heap_offset
+            ) = HEADER_V1.unpack_from(self.map, 0)
+        else:
+            (
+                _, _, _, self.count, self.row_size,
+                schema_offset, schema_length, self.rows_offset, self.heap_offset,
+                directory_offset, directory_length
+            ) = HEADER.unpack_from(self.map, 0)
+            self.indexes = json.loads(self.map[directory_offset:directory_offset + directory_length])
+        self.schema = [tuple(field) for field in json.loads(self.map[schema_offset:schema_offset + schema_length])]
+        self.row = struct.Struct("<QQ" + "".join(FORMATS[kind] for _, kind in self.schema))
+        # Position of each field in the unpacked row tuple
+        self.positions: Dict[str,Tuple[int,int,str]] = {}
+        position = 2
+        for bit, (field, kind) in enumerate(self.schema):
+            self.positions[field] = (bit, position, kind)
+            position += 2 if kind in (STR, JSON) else 1
+        if key not in self.positions:
+            raise ValueError(f"{path} has no {key} field")
+        self._keys: Optional[List[str]] = None
+        # Whole columns decoded for walks over every row, see cache_columns()
+        self.columns: Optional[Dict[str,list]] = None
+
+    def cache_columns(self, enabled:bool = True):
+        """
+        While enabled, reading a field of one row decodes and keeps the
+        field of every row, so index rebuilds decode each column once and
+        share the strings. Disabled once the table is indexed
+        """
+        self.columns = {} if enabled else None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def unpack(self, i:int) -> tuple:
+        return self.row.unpack_from(self.map, self.rows_offset + i * self.row_size)
+
+    def value(self, values:tuple, bit:int, position:int, kind:str):
+        if values[1] >> bit & 1:
+            return None
+        if kind == UUID:
+            return format_uuid(values[position])
+        if kind == TIME:
+            return format_time(values[position])
+        start = self.heap_offset + values[position]
+        data = self.map[start:start + values[position + 1]]
+        return data.decode() if kind == STR else json.loads(data)
+
+    def record(self, i:int) -> dict:
+        values = self.unpack(i)
+        present = values[0]
+        return {
+            field: self.value(values, bit, position, kind)
+            for field, (bit, position, kind) in self.positions.items()
+            if present >> bit & 1
+        }
+
+    def field(self, i:int, field:str):
+        columns = self.columns
+        if columns is not None:
+            value = (columns.get(field) or self.column(field))[i]
+            if value is MISSING:
+                raise KeyError(field)
+            return value
+        values = self.unpack(i)
+        bit, position, kind = self.positions[field]
+        if not values[0] >> bit & 1:
+            raise KeyError(field)
+        return self.value(values, bit, position, kind)
+
+    def has_field(self, i:int, field:str) -> bool:
+        if field not in self.positions:
+            return False
+        if self.columns is not None:
+            return self.column(field)[i] is not MISSING
+        return bool(self.unpack(i)[0] >> self.positions[field][0] & 1)
+
+    def decode(self, field:str) -> list:
+        """
+        The values of `field` in every row (MISSING where it is absent),
+        decoded in one pass
+        """
+        bit, _, kind = self.positions[field]
+        offset = struct.calcsize("<QQ" + "".join(FORMATS[kind] for _, kind in self.schema[:bit]))
+        size = struct.calcsize("<" + FORMATS[kind])
+        rows = self.map[self.rows_offset:self.heap_offset]
+        # The field of every row, back to back, one strided copy per byte
+        data = bytearray(size * self.count)
+        for byte in range(size):
+            data[byte::size] = rows[offset + byte::self.row_size]
+        # Absent and null fields are zeros, decoded like the rest and
+        # replaced below
+        if kind == UUID:
+            values = format_uuids(data)
+        elif kind == TIME:
+            values = [str(EPOCH + timedelta(0, 0, micros)) for micros in struct.unpack(f"<{self.count}q", data)]
+        else:
+            heap = self.map[self.heap_offset:]
+            refs = struct.iter_unpack("<QI", data)
+            if kind == STR:
+                values = [heap[start:start + length].decode() for start, length in refs]
+            else:
+                values = [json.loads(heap[start:start + length]) if length else None for start, length in refs]
+        mask = 1 << bit % 8
+        present = rows[bit // 8::self.row_size]
+        null = rows[8 + bit // 8::self.row_size]
+        # Usually every row has the field and it isn't null
+        if present.translate(None, bytes(b for b in range(256) if b & mask)) or \
+                null.translate(None, bytes(b for b in range(256) if not b & mask)):
+            for i in range(self.count):
+                if not present[i] & mask:
+                    values[i] = MISSING
+                elif null[i] & mask:
+                    values[i] = None
+        return values
+
+    def column(self, field:str) -> list:
+        column = self.columns.get(field)
+        if column is None:
+            column = self.columns[field] = self.decode(field)
+        return column
+
+    def keys(self) -> List[str]:
+        """
+        Every key in order. Decoded once and kept: the indexes hold on
+        to the same strings
+        """
+        if self._keys is None:
+            self._keys = self.decode(self.key)
+        return self._keys
+
+    def key_at(self, i:int) -> str:
+        return self.keys()[i]
+
+    def index(self, name:str) -> Optional[Tuple[Optional[List[tuple]],List[tuple]]]:
+        """
+        The (groups, entries) stored for the index `name`, see write(),
+        None if there are none
+        """
+        meta = self.indexes.get(name)
+        if not meta:
+            return None
+        count, offset = meta["count"], meta["offset"]
+        numbers = unpack_array("I", self.map[offset:offset + 4 * count])
+        offset += 4 * count
+        if meta["sort"] == "float":
+            values = unpack_array("d", self.map[offset:offset + 8 * count])
+        else:
+            values = map(meta["values"].__getitem__, unpack_array("I", self.map[offset:offset + 4 * count]))
+        keys = self.keys()
+        entries = list(zip(values, map(keys.__getitem__, numbers)))
+        groups = meta.get("groups")
+        return [tuple(group) for group in groups] if groups is not None else None, entries
+
+    def find(self, key:str) -> Optional[int]:
+        """
+        Row number of `key`, None if it isn't in the snapshot
+        """
+        keys = self.keys()
+        i = bisect.bisect_left(keys, key)
+        return i if i < len(keys) and keys[i] == key else None
+
+class RowView:
+    """
+    RowView
+
+    Read-only mapping over one snapshot row that decodes only the fields
+    that are read, for index rebuilds that look at one or two fields of
+    every record
+    """
+    __slots__ = ("snapshot", "i")
+
+    def __init__(self, snapshot:Snapshot, i:int):
+        self.snapshot = snapshot
+        self.i = i
+
+    def __getitem__(self, field:str):
+        try:
+            value = self.snapshot.columns[field][self.i]
+        except (KeyError, TypeError):
+            # Column not decoded yet, or columns not cached
+            return self.snapshot.field(self.i, field)
+        if value is MISSING:
+            raise KeyError(field)
+        return value
+
+    def get(self, field:str, default = None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def __contains__(self, field:str) -> bool:
+        return self.snapshot.has_field(self.i, field)
+
+    def keys(self):
+        return self.snapshot.record(self.i).keys()
+
+    def items(self):
+        return self.snapshot.record(self.i).items()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+class LazyRows(MutableMapping):
+    """
+    LazyRows
+
+    The rows of a Table backed by a Snapshot. Records are decoded when
+    first read and the last `memo` of them are kept, so repeated reads
+    return the same object (SerializedCache relies on it). Writes go to
+    an in-memory overlay that shadows the snapshot until the next one is
+    written and rebase() moves the rows onto it.
+
+    items() and values() yield RowViews for snapshot rows, so walking the
+    whole table doesn't decode or keep every record.
+    """
+    def __init__(self, snapshot:Snapshot, memo:int = 100_000):
+        self.snapshot = snapshot
+        self.overlay: Dict[str,dict] = {}
+        self.deleted = set()
+        self.memo: "OrderedDict[str,dict]" = OrderedDict()
+        self.memo_size = memo
+        self.memo_lock = threading.Lock()
+        self.size = len(snapshot)
+
+    def base(self, key:str) -> Optional[int]:
+        if key in self.deleted:
+            return None
+        return self.snapshot.find(key)
+
+    def remember(self, key:str, record:dict):
+        with self.memo_lock:
+            self.memo[key] = record
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+
+    def __getitem__(self, key:str) -> dict:
+        record = self.overlay.get(key)
+        if record is not None:
+            return record
+        # Before the memo: a read racing with a delete may memoize the
+        # record after the delete dropped it
+        if key in self.deleted:
+            raise KeyError(key)
+        with self.memo_lock:
+            record = self.memo.get(key)
+            if record is not None:
+                self.memo.move_to_end(key)
+                return record
+        snapshot = self.snapshot
+        i = snapshot.find(key)
+        if i is None:
+            raise KeyError(key)
+        record = snapshot.record(i)
+        self.remember(key, record)
+        return record
+
+    def __contains__(self, key) -> bool:
+        return key in self.overlay or self.base(key) is not None
+
+    def __setitem__(self, key:str, record:dict):
+        if key not in self:
+            self.size += 1
+        self.overlay[key] = record
+        self.deleted.discard(key)
+        with self.memo_lock:
+            self.memo.pop(key, None)
+
+    def __delitem__(self, key:str):
+        if key not in self:
+            raise KeyError(key)
+        self.overlay.pop(key, None)
+        with self.memo_lock:
+            self.memo.pop(key, None)
+        if self.snapshot.find(key) is not None:
+            self.deleted.add(key)
+        self.size -= 1
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[str]:
+        overlay = dict(self.overlay)
+        deleted = set(self.deleted)
+        if not overlay and not deleted:
+            yield from self.snapshot.keys()
+            return
+        for key in self.snapshot.keys():
+            if key not in overlay and key not in deleted:
+                yield key
+        yield from overlay
+
+    def items(self) -> Iterator[tuple]:
+        snapshot = self.snapshot
+        overlay = dict(self.overlay)
+        deleted = set(self.deleted)
+        if overlay or deleted:
+            for i, key in enumerate(snapshot.keys()):
+                if key not in overlay and key not in deleted:
+                    yield key, RowView(snapshot, i)
+        else:
+            for i, key in enumerate(snapshot.keys()):
+                yield key, RowView(snapshot, i)
+        yield from overlay.items()
+
+    def values(self) -> Iterator:
+        for _, record in self.items():
+            yield record
+
+    def copy(self) -> "LazyRows":
+        """
+        The current rows, sharing the snapshot, for records() to walk
+        while writes go on
+        """
+        rows = LazyRows(self.snapshot, memo=0)
+        rows.overlay = dict(self.overlay)
+        rows.deleted = set(self.deleted)
+        rows.size = self.size
+        return rows
+
+    def records(self) -> Iterator[dict]:
+        """
+        Every record as a dict, in key order, without keeping them
+        """
+        snapshot = self.snapshot
+        overlay = sorted(self.overlay.items())
+        j = 0
+        for i, key in enumerate(snapshot.keys()):
+            while j < len(overlay) and overlay[j][0] < key:
+                yield overlay[j][1]
+                j += 1
+            if key in self.deleted or (j < len(overlay) and overlay[j][0] == key):
+                continue
+            yield snapshot.record(i)
+        for _, record in overlay[j:]:
+            yield record
+
+    def rebase(self, snapshot:Snapshot, written:"LazyRows"):
+        """
+        Moves onto `snapshot`, written from `written` (a copy() of these
+        rows): the overlay keeps only what changed since the copy.
+
+        Readers don't take the table lock, so every step leaves a
+        consistent view: first deleted is widened to what is deleted for
+        the old and the new snapshot, then the snapshot is swapped.
+        """
+        # Deleted since the copy, or written into the new snapshot and
+        # deleted since
+        deleted = (self.deleted - written.deleted) | {
+            key for key in written.overlay if key not in self.overlay
+        }
+        self.deleted = self.deleted | deleted
+        self.snapshot = snapshot
+        self.deleted = deleted
+        overlay = {}
+        for key, record in self.overlay.items():
+            if written.overlay.get(key) is record:
+                # Same object as before, so cached serializations stay valid
+                self.remember(key, record)
+            else:
+                overlay[key] = record
+        self.overlay = overlay
@@ -0,0 +1,1392 @@
+# Python
+import os
+import json
+import queue
+import asyncio
+import time
+import uuid
+import base64
+import heapq
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime,timezone
+from concurrent.futures import Future,ThreadPoolExecutor
+from typing import Callable,Dict,Iterator,List,Optional,Tuple,Union
+# Storage
+from backends import Backend,make_backend
+from columns import KEY,REF,TEXT,TIME,ColumnarRows
+from search import SearchIndex
+# Metrics
+from metrics import serialize_duration,storage_batch_size,storage_commit_duration
+from metrics import cache_evictions,cache_hits,cache_invalidations,cache_misses
+
+USERS_FILE = os.environ.get("TWITTER_USERS_FILE", "user.json")
+TWEETS_FILE = os.environ.get("TWITTER_TWEETS_FILE", "tweets.json")
+FOLLOWS_FILE = os.environ.get("TWITTER_FOLLOWS_FILE", "follows.json")
+COMPACT_INTERVAL = float(os.environ.get("TWITTER_COMPACT_INTERVAL", "30"))
+COMPACT_THRESHOLD = int(os.environ.get("TWITTER_COMPACT_THRESHOLD", "1000"))
+WRITE_BATCH = int(os.environ.get("TWITTER_WRITE_BATCH", "256"))
+IO_WORKERS = int(os.environ.get("TWITTER_IO_WORKERS", "4"))
+TIMELINE_SIZE = int(os.environ.get("TWITTER_TIMELINE_SIZE", "800"))
+FANOUT_LIMIT = int(os.environ.get("TWITTER_FANOUT_LIMIT", "10000"))
+CACHE_SIZE = int(os.environ.get("TWITTER_CACHE_SIZE", "100000"))
+CACHE_TTL = float(os.environ.get("TWITTER_CACHE_TTL", "300"))
+# Seconds between polls for the writes of other processes (shared backends)
+SYNC_INTERVAL = float(os.environ.get("TWITTER_SYNC_INTERVAL", "0.05"))
+# Keep tweets in columns (see columns.py) rather than one dict each
+COLUMNAR = os.environ.get("TWITTER_COLUMNAR", "1") == "1"
+
+logger = logging.getLogger(__name__)
+
+# Blocking disk work that doesn't go through the Writer (loading, closing,
+# tables without a writer) runs here, never on the event loop
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+# Indexes
+
+def timestamp(value) -> float:
+    """
+    Sort key for the created_at strings the handlers write. Naive values
+    are read as UTC, so the key doesn't depend on the time zone of the
+    process that computed it (indexes are stored in snapshots)
+    """
+    if not value:
+        return 0.0
+    moment = datetime.fromisoformat(str(value))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+def encode_cursor(entry:tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(entry)).encode()).decode()
+
+# Sort keys of the indexes other than users_by_id: timestamps, scores
+NUMBER = (int, float)
+
+def decode_cursor(cursor:str, value_type = NUMBER) -> tuple:
+    """
+    Raises ValueError if the cursor wasn't made by encode_cursor() for
+    an index whose sort keys are of `value_type`
+    """
+    try:
+        entry = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(entry, list) or len(entry) != 2:
+        raise ValueError("Invalid cursor")
+    value, key = entry
+    # Compared with the (sort key, key) entries of the index
+    if isinstance(value, bool) or not isinstance(value, value_type) or not isinstance(key, str):
+        raise ValueError("Invalid cursor")
+    return tuple(entry)
+
+def spread(entries:List[tuple], count:int = 4) -> List[tuple]:
+    """
+    A few entries from all over `entries`, to check a stored index
+    against the records before using it
+    """
+    return entries[::max(1, len(entries) // count)]
+
+class SortedIndex:
+    """
+    SortedIndex
+
+    Keys of a table ordered by (sort_key(record), key), kept up to date
+    with bisect on every write. A page is a slice of the list, so its cost
+    depends on the page size and not on the table size.
+    """
+    def __init__(self, sort_key:Callable[[dict],object], value_type = NUMBER):
+        self.sort_key = sort_key
+        # Of the sort keys, for decode_cursor()
+        self.value_type = value_type
+        self.entries: List[tuple] = []
+        self.positions: Dict[str,tuple] = {}
+
+    def rebuild(self, rows:Dict[str,dict]):
+        self.positions = {key: (self.sort_key(record), key) for key, record in rows.items()}
+        self.entries = sorted(self.positions.values())
+
+    def add(self, key:str, record:dict):
+        self.remove(key)
+        entry = (self.sort_key(record), key)
+        bisect.insort(self.entries, entry)
+        self.positions[key] = entry
+
+    def remove(self, key:str):
+        entry = self.positions.pop(key, None)
+        if entry is None:
+            return
+        i = bisect.bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            del self.entries[i]
+
+    def dump(self) -> Tuple[None,List[tuple]]:
+        """
+        (groups, entries) for a backend to store, see restore()
+        """
+        return None, list(self.entries)
+
+    def restore(self, rows:Dict[str,dict], groups:None, entries:List[tuple]) -> bool:
+        """
+        Takes the entries of dump() instead of rebuilding from `rows`.
+        False if they don't match the records: sort keys computed by
+        other code, e.g. timestamps read in local time by older versions
+        """
+        if groups is not None:
+            return False
+        for value, key in spread(entries):
+            if key not in rows or self.sort_key(rows[key]) != value:
+                return False
+        self.entries = entries
+        self.positions = {entry[1]: entry for entry in entries}
+        return True
+
+    def bounds(self, low=None, high=None) -> Tuple[int,int]:
+        """
+        Positions of the entries with low <= sort key < high (either one
+        None for no bound)
+        """
+        entries = self.entries
+        # (value,) sorts before every (value, key)
+        start = bisect.bisect_left(entries, (low,)) if low is not None else 0
+        end = bisect.bisect_left(entries, (high,)) if high is not None else len(entries)
+        return start, max(start, end)
+
+    def page(
+        self,
+        limit:int,
+        cursor:Optional[tuple] = None,
+        descending:bool = False,
+        low = None,
+        high = None
+    ) -> Tuple[List[str],Optional[tuple]]:
+        """
+        Returns the keys of the page and the cursor of the next one
+        (None on the last page). With `low` or `high` only the entries
+        in that range of sort keys, found with bisect, so a page costs
+        O(log n + limit)
+        """
+        entries = self.entries
+        first, last = self.bounds(low, high)
+        if descending:
+            end = min(last, bisect.bisect_left(entries, cursor)) if cursor else last
+            start = max(first, end - limit)
+            chunk = entries[start:end][::-1]
+            more = start > first
+        else:
+            start = max(first, bisect.bisect_right(entries, cursor)) if cursor else first
+            chunk = entries[start:min(last, start + limit)]
+            more = start + limit < last
+        next_cursor = chunk[-1] if chunk and more else None
+        return [key for _, key in chunk], next_cursor
+
+class HashIndex:
+    """
+    HashIndex
+
+    Maps value(record) to the key of the record, for O(1) lookups on a
+    field other than the primary key (e.g. a user email).
+
+    With `unique` (the name of the field) the table rejects writes that
+    would give a record the value of another one, see Table.check()
+    """
+    def __init__(self, value:Callable[[dict],object], unique:Optional[str] = None):
+        self.value = value
+        self.unique = unique
+        self.keys: Dict[object,str] = {}
+        self.positions: Dict[str,object] = {}
+
+    def rebuild(self, rows:Dict[str,dict]):
+        self.keys = {}
+        self.positions = {}
+        duplicates = 0
+        for key, record in rows.items():
+            value = self.value(record)
+            self.positions[key] = value
+            # The first record wins, as the old linear scans did
+            if self.keys.setdefault(value, key) != key:
+                duplicates += 1
+        if duplicates and self.unique:
+            logger.warning("%d records share their %s with an older one", duplicates, self.unique)
+
+    def add(self, key:str, record:dict):
+        self.remove(key)
+        value = self.value(record)
+        self.positions[key] = value
+        self.keys[value] = key
+
+    def remove(self, key:str):
+        if key not in self.positions:
+            return
+        value = self.positions.pop(key)
+        if self.keys.get(value) == key:
+            del self.keys[value]
+
+    def get(self, value) -> Optional[str]:
+        return self.keys.get(value)
+
+class GroupIndex:
+    """
+    GroupIndex
+
+    Keys of a table grouped by value(record) (e.g. the tweets of each
+    author), every group ordered by (sort_key(record), key)
+    """
+    def __init__(self, value:Callable[[dict],object], sort_key:Callable[[dict],object]):
+        self.value = value
+        self.sort_key = sort_key
+        self.groups: Dict[object,List[tuple]] = {}
+        self.positions: Dict[str,Tuple[object,tuple]] = {}
+
+    def rebuild(self, rows:Dict[str,dict]):
+        self.groups = {}
+        self.positions = {}
+        for key, record in rows.items():
+            value, entry = self.value(record), (self.sort_key(record), key)
+            self.groups.setdefault(value, []).append(entry)
+            self.positions[key] = (value, entry)
+        for entries in self.groups.values():
+            entries.sort()
+
+    def add(self, key:str, record:dict):
+        self.remove(key)
+        value, entry = self.value(record), (self.sort_key(record), key)
+        bisect.insort(self.groups.setdefault(value, []), entry)
+        self.positions[key] = (value, entry)
+
+    def remove(self, key:str):
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+        value, entry = position
+        entries = self.groups[value]
+        i = bisect.bisect_left(entries, entry)
+        if i < len(entries) and entries[i] == entry:
+            del entries[i]
+        if not entries:
+            del self.groups[value]
+
+    def dump(self) -> Tuple[List[tuple],List[tuple]]:
+        """
+        (groups, entries) for a backend to store: the (value, size) of
+        every group and the entries of all of them, see restore()
+        """
+        groups = [(value, len(entries)) for value, entries in self.groups.items()]
+        return groups, [entry for entries in self.groups.values() for entry in entries]
+
+    def restore(self, rows:Dict[str,dict], groups:Optional[List[tuple]], entries:List[tuple]) -> bool:
+        """
+        Takes the groups and entries of dump() instead of rebuilding from
+        `rows`. False if they don't match the records
+        """
+        if groups is None:
+            return False
+        restored = {}
+        positions = {}
+        start = 0
+        for value, size in groups:
+            group = restored[value] = entries[start:start + size]
+            start += size
+            for entry in group:
+                positions[entry[1]] = (value, entry)
+        for sort_value, key in spread(entries):
+            if key not in rows:
+                return False
+            record = rows[key]
+            if (self.value(record), self.sort_key(record)) != (positions[key][0], sort_value):
+                return False
+        self.groups = restored
+        self.positions = positions
+        return True
+
+    def count(self, value) -> int:
+        return len(self.groups.get(value, ()))
+
+    def keys(self, value) -> List[str]:
+        return [key for _, key in self.groups.get(value, ())]
+
+    def recent(self, value, limit:int, before:Optional[tuple] = None) -> List[tuple]:
+        """
+        The last `limit` entries of the group (before `before`), newest first
+        """
+        entries = self.groups.get(value, [])
+        end = bisect.bisect_left(entries, before) if before else len(entries)
+        return entries[max(0, end - limit):end][::-1]
+
+    def page(self, value, limit:int, cursor:Optional[tuple] = None) -> Tuple[List[str],Optional[tuple]]:
+        """
+        Keys of one page of the group, newest first, and the cursor of
+        the next page (None on the last one)
+        """
+        entries = self.recent(value, limit + 1, cursor)
+        next_cursor = entries[limit - 1] if len(entries) > limit else None
+        return [key for _, key in entries[:limit]], next_cursor
+
+class SerializedCache:
+    """
+    SerializedCache
+
+    The json bytes of each record as the API returns them, made by
+    `serialize` the first time the record is read and dropped when it is
+    written, so reads skip validation and encoding.
+
+    Bounded LRU: past `size` entries the least recently read one is
+    evicted, and entries older than `ttl` seconds (0 for no limit) are
+    made again.
+
+    An entry is only served for the exact record object it was made
+    from, so a read racing with a write never brings back stale bytes.
+
+    Reads with store=False (full-table scans) use the entries there are
+    but add none and don't refresh any, so they don't push out the ones
+    hot reads need.
+    """
+    def __init__(self, serialize:Callable[[dict],bytes], name:str = "", size:int = CACHE_SIZE, ttl:float = CACHE_TTL):
+        self.serialize = serialize
+        self.name = name or serialize.__name__
+        self.size = size
+        self.ttl = ttl
+        # Read from request threads and written by the Writer
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str,Tuple[dict,bytes,float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def rebuild(self, rows:Dict[str,dict]):
+        with self.lock:
+            self.entries = OrderedDict()
+
+    def add(self, key:str, record:dict):
+        self.remove(key)
+
+    def remove(self, key:str):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                cache_invalidations.inc(self.name)
+
+    def get(self, key:str, record:dict, store:bool = True) -> bytes:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is record:
+                if not self.ttl or now - entry[2] < self.ttl:
+                    if store:
+                        self.entries.move_to_end(key)
+                    cache_hits.inc(self.name)
+                    return entry[1]
+                cache_evictions.inc(self.name, "ttl")
+        cache_misses.inc(self.name)
+        start = time.perf_counter()
+        data = self.serialize(record)
+        serialize_duration.observe(time.perf_counter() - start, self.name)
+        if not store:
+            return data
+        with self.lock:
+            self.entries[key] = (record, data, now)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                cache_evictions.inc(self.name, "size")
+        return data
+
+class Versions:
+    """
+    Versions
+
+    Monotonic version of a table and of each of its records, bumped on
+    every write, with the time of the write. `epoch` changes on every
+    start so versions from a previous run never look current.
+    """
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.modified = time.time()
+        self.records: Dict[str,Tuple[int,float]] = {}
+
+    def rebuild(self, rows:Dict[str,dict]):
+        self.bump()
+        self.records = {key: (self.version, self.modified) for key in rows}
+
+    def bump(self):
+        self.version += 1
+        self.modified = time.time()
+
+    def add(self, key:str, record:dict):
+        self.bump()
+        self.records[key] = (self.version, self.modified)
+
+    def remove(self, key:str):
+        self.bump()
+        self.records.pop(key, None)
+
+    def get(self, key:str) -> Tuple[int,float]:
+        return self.records.get(key, (0, 0.0))
+
+# Timelines
+
+class Timelines:
+    """
+    Timelines
+
+    Home timeline of each user: the newest `size` (created_at, tweet_id)
+    entries of the users they follow and their own, kept sorted.
+
+    A timeline is built the first time it is read and from then on every
+    new tweet is pushed to the timelines of its author's followers (fan
+    out on write). Authors with more than `fanout_limit` followers are
+    not pushed; their tweets are merged in when a timeline is read (fan
+    out on read).
+
+    Registered as an index of the tweets table; FollowHook drops a
+    timeline when its user follows or unfollows someone.
+    """
+    def __init__(self, tweets:"Table", follows:"Table", by_author:GroupIndex, followers:GroupIndex, following:GroupIndex, size:int = TIMELINE_SIZE, fanout_limit:int = FANOUT_LIMIT):
+        self.tweets = tweets
+        self.follows = follows
+        self.by_author = by_author
+        self.followers = followers
+        self.following = following
+        self.size = size
+        self.fanout_limit = fanout_limit
+        self.timelines: Dict[str,List[tuple]] = {}
+
+    def followees(self, user_id:str) -> set:
+        followees = {
+            record["followee_id"]
+            for record in self.follows.records(self.following.keys(user_id))
+        }
+        followees.add(user_id)
+        return followees
+
+    def is_celebrity(self, user_id:str) -> bool:
+        return self.followers.count(user_id) > self.fanout_limit
+
+    def timeline(self, user_id:str) -> List[tuple]:
+        timeline = self.timelines.get(user_id)
+        if timeline is not None:
+            return timeline
+        # Under the table lock so no tweet is posted halfway through
+        with self.tweets.lock:
+            entries = []
+            for followee in self.followees(user_id):
+                if not self.is_celebrity(followee):
+                    entries.extend(self.by_author.recent(followee, self.size))
+            entries.sort()
+            timeline = entries[-self.size:]
+            self.timelines[user_id] = timeline
+        return timeline
+
+    def drop(self, user_id:str):
+        self.timelines.pop(user_id, None)
+
+    def rebuild(self, rows:Dict[str,dict]):
+        self.timelines = {}
+
+    def add(self, key:str, record:dict):
+        author = record.get("author_id")
+        if author is None or self.is_celebrity(author):
+            return
+        entry = (self.by_author.sort_key(record), key)
+        readers = [
+            record["follower_id"]
+            for record in self.follows.records(self.followers.keys(author))
+        ]
+        readers.append(author)
+        for reader in readers:
+            timeline = self.timelines.get(reader)
+            if timeline is None:
+                continue
+            i = bisect.bisect_left(timeline, entry)
+            if i < len(timeline) and timeline[i] == entry:
+                continue
+            timeline.insert(i, entry)
+            if len(timeline) > self.size:
+                del timeline[0]
+
+    def remove(self, key:str):
+        # Deleted tweets are skipped when the timeline is read
+        pass
+
+    def page(self, user_id:str, limit:int, cursor:Optional[tuple] = None) -> Tuple[List[str],Optional[tuple]]:
+        """
+        Keys of one page of the timeline, newest first, and the cursor of
+        the next page (None on the last one)
+        """
+        timeline = self.timeline(user_id)
+        end = bisect.bisect_left(timeline, cursor) if cursor else len(timeline)
+        followees = self.followees(user_id)
+        sources = [timeline[:end][::-1]]
+        for followee in followees:
+            if self.is_celebrity(followee):
+                sources.append(self.by_author.recent(followee, limit + 1, cursor))
+        keys = []
+        last = None
+        seen = set()
+        for entry in heapq.merge(*sources, reverse=True):
+            key = entry[1]
+            tweet = self.tweets.rows.get(key)
+            if key in seen or tweet is None or tweet.get("author_id") not in followees:
+                continue
+            if len(keys) == limit:
+                return keys, last
+            seen.add(key)
+            keys.append(key)
+            last = entry
+        return keys, None
+
+class FollowHook:
+    """
+    FollowHook
+
+    Index of the follows table that drops the timeline of a user when
+    they follow or unfollow someone, so it is built again on next read
+    """
+    def __init__(self, timelines:Timelines):
+        self.timelines = timelines
+
+    def rebuild(self, rows:Dict[str,dict]):
+        self.timelines.timelines = {}
+
+    def add(self, key:str, record:dict):
+        self.timelines.drop(record["follower_id"])
+
+    def remove(self, key:str):
+        self.timelines.drop(follower_of(key))
+
+def follow_id(follower_id:str, followee_id:str) -> str:
+    return f"{follower_id}:{followee_id}"
+
+def moved_follow(follow:dict, old_id:str, new_id:str) -> dict:
+    """
+    The follow with the user `old_id` renamed to `new_id`
+    """
+    follower = new_id if follow["follower_id"] == old_id else follow["follower_id"]
+    followee = new_id if follow["followee_id"] == old_id else follow["followee_id"]
+    return {
+        **follow,
+        "follow_id": follow_id(follower, followee),
+        "follower_id": follower,
+        "followee_id": followee
+    }
+
+def follower_of(follow_key:str) -> str:
+    return follow_key.split(":")[0]
+
+# Tables
+
+class Conflict(Exception):
+    """
+    A write that would give a record the key or a unique value (see
+    HashIndex) of another record
+    """
+    def __init__(self, field:str, value):
+        super().__init__(f"{field} {value!r} already exists")
+        self.field = field
+        self.value = value
+
+class Table:
+    """
+    Table
+
+    Keeps every record of a json file in memory, indexed by its UUID
+    (stored as str, the same way the handlers write it to disk).
+
+    Writes are persisted through a Backend (json files or SQLite), one
+    batch of log entries at a time. Reads never touch the disk.
+
+    When a Writer is attached every mutation goes through its queue,
+    otherwise it is committed right away on the calling thread.
+
+    With a shared backend (SQLite used by several workers) sync() applies
+    the writes of the other processes, through the indexes like local
+    ones, so their caches and versions are invalidated too.
+
+    Every mutation has an async twin (ainsert, aupdate, ...) for async
+    path operations: it waits for the commit without blocking the loop.
+
+    With `columns` the rows are kept in ColumnarRows, and reads return
+    read-only mappings instead of dicts.
+    """
+    def __init__(self, backend:Backend, key:str, columns:Optional[Dict[str,str]] = None):
+        self.backend = backend
+        self.key = key
+        # Fields of the records, to keep them in ColumnarRows
+        self.columns = columns
+        self.rows: Dict[str,dict] = {}
+        self.lock = threading.RLock()
+        self.writer: Optional["Writer"] = None
+        self.versions = Versions()
+        self.indexes: list = [self.versions]
+        # Indexes with unique values, checked on every write
+        self.unique: List[HashIndex] = []
+        # (key, previous record) of the writes being committed, see rollback()
+        self.journal: Optional[List[tuple]] = None
+        # Indexes the backend may store with the rows, by name, see add_index()
+        self.stored: Dict[str,object] = {}
+
+    def load(self):
+        self.rows = self.arrange(self.backend.load())
+        self.reindex()
+        self.backend.applied()
+
+    def arrange(self, rows:Dict[str,dict]) -> Dict[str,dict]:
+        """
+        The rows as the table keeps them: in columns if it has some.
+        Rows the backend keeps lazily (binary snapshots) stay as they are
+        """
+        if self.columns is None or not isinstance(rows, dict):
+            return rows
+        columnar = ColumnarRows(self.key, self.columns)
+        for key in list(rows):
+            columnar[key] = rows.pop(key)
+        return columnar
+
+    def reindex(self):
+        restored = {
+            id(index) for name, index in self.stored.items()
+            if self.backend.restore(name, index, self.rows)
+        }
+        for index in self.indexes:
+            if id(index) not in restored:
+                index.rebuild(self.rows)
+
+    def compact(self):
+        self.backend.compact(self.lock, self.rows, self.stored)
+
+    def sync(self):
+        """
+        Catches up with the writes other processes committed
+        """
+        with self.lock:
+            entries = self.backend.changes()
+            if entries is None:
+                self.reload()
+            elif entries:
+                self.apply(entries)
+                self.backend.applied()
+
+    def reload(self):
+        with self.lock:
+            self.rows = self.arrange(self.backend.read())
+            self.reindex()
+            self.backend.applied()
+
+    def apply(self, entries:List[dict]):
+        for entry in entries:
+            if entry["op"] == "put":
+                record = entry["record"]
+                self.rows[record[self.key]] = record
+                self.index_put(record[self.key], record)
+            elif entry["op"] == "delete" and self.rows.pop(entry["key"], None) is not None:
+                self.index_remove(entry["key"])
+
+    def close(self):
+        self.compact()
+        self.backend.close()
+
+    def version(self, key:Optional[str] = None) -> Tuple[str,int,float]:
+        """
+        (epoch, version, time of the last write) of the table, or of one
+        record with a `key`, for validators.
+
+        With a shared backend they come from it (the position of the
+        SQLite change feed), so every worker gives the same data the same
+        version. Records have the version of the table then
+        """
+        versions = self.versions
+        shared = self.backend.version()
+        if shared is not None:
+            epoch, version = shared
+            return epoch, version, versions.modified
+        if key is None:
+            return versions.epoch, versions.version, versions.modified
+        return (versions.epoch, *versions.get(key))
+
+    def get(self, key:str) -> Optional[dict]:
+        return self.rows.get(key)
+
+    def records(self, keys:List[str]) -> List[dict]:
+        """
+        The records of `keys`, skipping the ones deleted since the keys
+        were read: each record is read once, a check then a read could
+        race with the Writer
+        """
+        rows = self.rows
+        return [record for record in map(rows.get, keys) if record is not None]
+
+    def all(self) -> List[dict]:
+        return list(self.rows.values())
+
+    def find(self, index:HashIndex, value) -> Optional[dict]:
+        key = index.get(value)
+        return self.rows.get(key) if key is not None else None
+
+    def page(
+        self,
+        index:SortedIndex,
+        limit:int,
+        cursor:Optional[str] = None,
+        descending:bool = False,
+        low = None,
+        high = None
+    ) -> Tuple[List[dict],Optional[str]]:
+        """
+        Keyset pagination over one of the table indexes, optionally only
+        over the records with low <= sort key < high.
+
+        Raises ValueError on an invalid cursor
+        """
+        keys, next_entry = index.page(
+            limit,
+            decode_cursor(cursor, index.value_type) if cursor else None,
+            descending,
+            low,
+            high
+        )
+        records = self.records(keys)
+        return records, encode_cursor(next_entry) if next_entry else None
+
+    def scan(
+        self,
+        index:SortedIndex,
+        chunk:int = 1000,
+        descending:bool = False,
+        low = None,
+        high = None
+    ) -> Iterator[List[dict]]:
+        """
+        Walks the table in index order, `chunk` records at a time, the
+        whole of it or the records with low <= sort key < high.
+
+        Each step is a keyset page, so nothing is copied up front and
+        concurrent writes don't break the walk.
+        """
+        cursor = None
+        while True:
+            keys, cursor = index.page(chunk, cursor, descending, low, high)
+            records = self.records(keys)
+            if records:
+                yield records
+            if cursor is None:
+                return
+
+    def add_index(self, index, name:Optional[str] = None):
+        """
+        With a `name` the backend may store the index with the rows and
+        restore it on load instead of rebuilding it (binary snapshots do,
+        for indexes with dump() and restore())
+        """
+        index.rebuild(self.rows)
+        self.indexes.append(index)
+        if name is not None:
+            self.stored[name] = index
+        if getattr(index, "unique", None):
+            self.unique.append(index)
+        return index
+
+    def check(self, record:dict, replaces:Optional[str] = None):
+        """
+        Raises Conflict if `record` has the key or a unique value of a
+        record other than the one it replaces. O(1) per unique index
+        """
+        key = record[self.key]
+        if key != replaces and key in self.rows:
+            raise Conflict(self.key, key)
+        for index in self.unique:
+            value = index.value(record)
+            owner = index.get(value) if value is not None else None
+            if owner is not None and owner != key and owner != replaces:
+                raise Conflict(index.unique, value)
+
+    def put(self, key:str, record:dict):
+        if self.journal is not None:
+            self.journal.append((key, self.rows.get(key)))
+        self.rows[key] = record
+        self.index_put(key, record)
+
+    def drop(self, key:str) -> Optional[dict]:
+        record = self.rows.pop(key, None)
+        if record is not None:
+            if self.journal is not None:
+                self.journal.append((key, record))
+            self.index_remove(key)
+        return record
+
+    def rollback(self, mark:int = 0):
+        """
+        Undoes the writes put() and drop() journaled after the first
+        `mark`, newest first
+        """
+        while len(self.journal) > mark:
+            key, record = self.journal.pop()
+            if record is None:
+                if self.rows.pop(key, None) is not None:
+                    self.index_remove(key)
+            else:
+                self.rows[key] = record
+                self.index_put(key, record)
+
+    def index_put(self, key:str, record:dict):
+        for index in self.indexes:
+            index.add(key, record)
+
+    def index_remove(self, key:str):
+        for index in self.indexes:
+            index.remove(key)
+
+    def insert(self, record:dict) -> dict:
+        return self.submit("insert", record)
+
+    def replace(self, key:str, record:dict) -> Optional[dict]:
+        return self.submit("replace", key, record)
+
+    def update(self, key:str, changes:dict) -> Optional[dict]:
+        return self.submit("update", key, changes)
+
+    def delete(self, key:str) -> Optional[dict]:
+        return self.submit("delete", key)
+
+    def insert_many(self, records:List[dict]) -> List[Union[dict,Conflict]]:
+        return self.submit("insert_many", records)
+
+    def replace_group(self, index:GroupIndex, value, replace:Callable[[dict],Optional[dict]]) -> int:
+        return self.submit("replace_group", index, value, replace)
+
+    def delete_group(self, index:GroupIndex, value) -> int:
+        return self.submit("replace_group", index, value, lambda record: None)
+
+    async def ainsert(self, record:dict) -> dict:
+        return await self.asubmit("insert", record)
+
+    async def ainsert_many(self, records:List[dict]) -> List[Union[dict,Conflict]]:
+        return await self.asubmit("insert_many", records)
+
+    async def areplace(self, key:str, record:dict) -> Optional[dict]:
+        return await self.asubmit("replace", key, record)
+
+    async def aupdate(self, key:str, changes:dict) -> Optional[dict]:
+        return await self.asubmit("update", key, changes)
+
+    async def adelete(self, key:str) -> Optional[dict]:
+        return await self.asubmit("delete", key)
+
+    async def areplace_group(self, index:GroupIndex, value, replace:Callable[[dict],Optional[dict]]) -> int:
+        return await self.asubmit("replace_group", index, value, replace)
+
+    async def adelete_group(self, index:GroupIndex, value) -> int:
+        return await self.asubmit("replace_group", index, value, lambda record: None)
+
+    async def asubmit(self, op:str, *args):
+        if self.writer is not None:
+            return await asyncio.wrap_future(self.writer.enqueue(self, op, args))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(io_executor, self.submit, op, *args)
+
+    def submit(self, op:str, *args):
+        if self.writer is not None:
+            return self.writer.enqueue(self, op, args).result()
+        with self.lock:
+            self.journal = []
+            try:
+                with self.backend.transaction():
+                    self.sync()
+                    result, entries = self.execute(op, args)
+                    if entries:
+                        self.backend.append(entries)
+            except Exception:
+                self.rollback()
+                raise
+            finally:
+                self.journal = None
+        return result
+
+    def execute(self, op:str, args:tuple) -> Tuple[Optional[dict],List[dict]]:
+        """
+        Applies a mutation to the rows.
+
+        Returns the result for the caller and the log entries to persist.
+        Raises Conflict for writes check() rejects; insert_many skips
+        those records instead and returns the Conflict in their place.
+
+        Rows are only changed through put() and drop(), so a mutation
+        that fails, or a batch that can't be persisted, is undone with
+        rollback()
+        """
+        if op == "insert":
+            record, = args
+            self.check(record)
+            self.put(record[self.key], record)
+            return record, [{"op": "put", "record": record}]
+        if op == "insert_many":
+            records, = args
+            results = []
+            entries = []
+            for record in records:
+                try:
+                    self.check(record)
+                except Conflict as e:
+                    results.append(e)
+                    continue
+                self.put(record[self.key], record)
+                results.append(record)
+                entries.append({"op": "put", "record": record})
+            return results, entries
+        if op == "replace":
+            key, record = args
+            if key not in self.rows:
+                return None, []
+            self.check(record, key)
+            self.drop(key)
+            entries = []
+            if record[self.key] != key:
+                entries.append({"op": "delete", "key": key})
+            self.put(record[self.key], record)
+            entries.append({"op": "put", "record": record})
+            return record, entries
+        if op == "update":
+            key, changes = args
+            if key not in self.rows:
+                return None, []
+            record = {**self.rows[key], **changes}
+            self.check(record, key)
+            self.put(key, record)
+            return record, [{"op": "put", "record": record}]
+        if op == "delete":
+            key, = args
+            record = self.drop(key)
+            if record is None:
+                return None, []
+            return record, [{"op": "delete", "key": key}]
+        if op == "replace_group":
+            # Every record of a group of `index` (e.g. the tweets of an
+            # author) replaced by replace(record), or deleted if it
+            # returns None. Only the group is read, and it is listed
+            # here so records written just before are included. Nothing
+            # is checked, it carries out a write that already was
+            index, value, replace = args
+            entries = []
+            count = 0
+            for key in index.keys(value):
+                record = self.rows.get(key)
+                if record is None:
+                    continue
+                count += 1
+                new = replace(record)
+                self.drop(key)
+                if new is None or new[self.key] != key:
+                    entries.append({"op": "delete", "key": key})
+                if new is not None:
+                    self.put(new[self.key], new)
+                    entries.append({"op": "put", "record": new})
+            return count, entries
+        raise ValueError(f"Unknown operation {op}")
+
+# Writer
+
+class Writer(threading.Thread):
+    """
+    Writer
+
+    Single thread that owns every mutation. Handlers put their mutation
+    in a queue and wait; the writer drains up to `batch` of them, applies
+    them in order and persists each table's share of the batch with one
+    log write (group commit).
+
+    For tables with a shared backend it also polls for the writes of
+    other processes every `interval` seconds, and catches up before each
+    commit while holding the backend's write lock, so no write is lost.
+
+    A mutation that fails, or a batch the backend can't persist, is
+    undone in memory too (Table.rollback()), so readers never see a
+    write that isn't stored.
+    """
+    def __init__(self, tables:List[Table] = (), batch:int = WRITE_BATCH, interval:float = SYNC_INTERVAL):
+        super().__init__(name="writer", daemon=True)
+        self.batch = batch
+        self.queue: "queue.Queue" = queue.Queue()
+        self.shared = [table for table in tables if table.backend.shared]
+        self.interval = interval if self.shared else None
+        self.synced = time.monotonic()
+
+    def enqueue(self, table:Table, op:str, args:tuple) -> Future:
+        future = Future()
+        self.queue.put((table, op, args, future))
+        return future
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.interval)
+            except queue.Empty:
+                self.sync()
+                continue
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.batch:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.commit(batch)
+                    return
+                batch.append(item)
+            self.commit(batch)
+            if self.interval and time.monotonic() - self.synced >= self.interval:
+                self.sync()
+
+    def sync(self):
+        self.synced = time.monotonic()
+        for table in self.shared:
+            try:
+                table.sync()
+            except Exception:
+                # Retried on the next poll
+                logger.exception("Failed to sync %s", table.backend.table)
+
+    def commit(self, batch:list):
+        tables: Dict[int,List[tuple]] = {}
+        for item in batch:
+            tables.setdefault(id(item[0]), []).append(item)
+        for items in tables.values():
+            table = items[0][0]
+            done = []
+            start = time.perf_counter()
+            try:
+                with table.lock:
+                    table.journal = []
+                    try:
+                        with table.backend.transaction():
+                            table.sync()
+                            entries = []
+                            for _, op, args, future in items:
+                                mark = len(table.journal)
+                                try:
+                                    result, changes = table.execute(op, args)
+                                except Exception as e:
+                                    table.rollback(mark)
+                                    future.set_exception(e)
+                                    continue
+                                entries.extend(changes)
+                                done.append((future, result))
+                            if entries:
+                                table.backend.append(entries)
+                    except Exception:
+                        # The batch isn't persisted (or was rolled back by
+                        # a shared backend), take it out of memory too
+                        table.rollback()
+                        raise
+                    finally:
+                        table.journal = None
+            except Exception as e:
+                for _, _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            storage_commit_duration.observe(time.perf_counter() - start, table.backend.table)
+            storage_batch_size.observe(len(items), table.backend.table)
+            for future, result in done:
+                future.set_result(result)
+
+    def stop(self):
+        self.queue.put(None)
+        if self.is_alive():
+            self.join()
+
+# Compaction
+
+class Compactor(threading.Thread):
+    """
+    Compactor
+
+    Background thread that compacts the backend of each table once it
+    holds more than `threshold` pending entries
+    """
+    def __init__(self, tables:List[Table], interval:float = COMPACT_INTERVAL, threshold:int = COMPACT_THRESHOLD):
+        super().__init__(name="compactor", daemon=True)
+        self.tables = tables
+        self.interval = interval
+        self.threshold = threshold
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for table in self.tables:
+                if table.backend.pending >= self.threshold:
+                    try:
+                        table.compact()
+                    except Exception:
+                        # Retried on the next interval
+                        logger.exception("Failed to compact %s", table.backend.table)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+# Repository
+
+# Field of a user whose user_id changed, with the old one, kept until
+# their tweets and follows are moved (see Repository.areplace_user())
+RENAMED_FROM = "renamed_from"
+
+def public(user:dict) -> dict:
+    """
+    A user record without its password hash
+    """
+    user = {key: value for key, value in user.items() if key not in ("password", RENAMED_FROM)}
+    birth_date = user.get("birth_date")
+    if isinstance(birth_date, str) and len(birth_date) > 10:
+        # Some users were saved with a datetime as birth_date
+        user["birth_date"] = birth_date[:10]
+    return user
+
+# Fields of the tweets the handlers write
+TWEET_COLUMNS = {
+    "tweet_id": KEY,
+    "content": TEXT,
+    "created_at": TIME,
+    "updated_at": TIME,
+    "author_id": REF
+}
+
+class Repository:
+    """
+    Repository
+
+    Users, tweets and follows of the app, loaded once at startup.
+
+    Tweets are stored with the author_id of their author only; join()
+    puts the current author back as "by" when a tweet is read.
+    """
+    def __init__(self, users_file:str = USERS_FILE, tweets_file:str = TWEETS_FILE, follows_file:str = FOLLOWS_FILE):
+        self.users = Table(make_backend(users_file, "users", "user_id"), "user_id")
+        self.tweets = Table(
+            make_backend(tweets_file, "tweets", "tweet_id"), "tweet_id",
+            columns=TWEET_COLUMNS if COLUMNAR else None
+        )
+        self.follows = Table(make_backend(follows_file, "follows", "follow_id"), "follow_id")
+        self.tables = [self.users, self.tweets, self.follows]
+        self.users_by_id = self.users.add_index(
+            SortedIndex(lambda user: user["user_id"], value_type=str)
+        )
+        self.users_by_email = self.users.add_index(
+            HashIndex(lambda user: user["email"], unique="email")
+        )
+        self.tweets_by_date = self.tweets.add_index(
+            SortedIndex(lambda tweet: timestamp(tweet.get("created_at"))),
+            name="by_date"
+        )
+        self.tweets_by_author = self.tweets.add_index(
+            GroupIndex(
+                lambda tweet: tweet.get("author_id"),
+                lambda tweet: timestamp(tweet.get("created_at"))
+            ),
+            name="by_author"
+        )
+        # Built after loading, see load()
+        self.tweets_by_content = self.tweets.add_index(
+            SearchIndex(lambda tweet: tweet.get("content"), background=True)
+        )
+        self.followers = self.follows.add_index(
+            GroupIndex(lambda follow: follow["followee_id"], lambda follow: follow["follower_id"]),
+            name="followers"
+        )
+        self.following = self.follows.add_index(
+            GroupIndex(lambda follow: follow["follower_id"], lambda follow: follow["followee_id"]),
+            name="following"
+        )
+        self.timelines = self.tweets.add_index(
+            Timelines(self.tweets, self.follows, self.tweets_by_author, self.followers, self.following)
+        )
+        self.follows.add_index(FollowHook(self.timelines))
+        self.compactor = None
+        self.writer = None
+
+    def load(self):
+        for table in self.tables:
+            table.load()
+        self.normalize()
+        for table in self.tables:
+            table.backend.loaded()
+        self.writer = Writer(self.tables)
+        self.writer.start()
+        for table in self.tables:
+            table.writer = self.writer
+        self.compactor = Compactor(self.tables)
+        self.compactor.start()
+        # The app serves everything but searches meanwhile
+        threading.Thread(target=self.tweets_by_content.build, name="search-index", daemon=True).start()
+
+    def normalize(self):
+        """
+        Replaces the author copy embedded in tweets written before
+        author_id by a reference to the user. Tweets whose author is not
+        a registered user keep their copy.
+
+        Also deletes the tweets and follows of users that don't exist
+        anymore, left behind when the process stopped between deleting
+        a user and deleting what was theirs (see adelete_user()).
+
+        Both are found through the indexes, by author and by user, so
+        the records of the users that exist aren't read. Users renamed
+        when the process stopped get their tweets and follows first (see
+        areplace_user()), so those aren't taken for lost
+        """
+        self.finish_renames()
+        changed = []
+        lost_tweets = []
+        for author_id, entries in self.tweets_by_author.groups.items():
+            if author_id is not None and author_id not in self.users.rows:
+                lost_tweets.extend(key for _, key in entries)
+        # Tweets from before author_id, or with an author_id of None
+        for key in self.tweets_by_author.keys(None):
+            tweet = self.tweets.rows[key]
+            if "author_id" in tweet:
+                lost_tweets.append(key)
+                continue
+            if "by" not in tweet:
+                continue
+            author_id = tweet["by"].get("user_id")
+            if author_id not in self.users.rows:
+                continue
+            tweet = {k: v for k, v in tweet.items() if k != "by"}
+            tweet["author_id"] = author_id
+            self.tweets.rows[key] = tweet
+            changed.append({"op": "put", "record": tweet})
+        for key in lost_tweets:
+            del self.tweets.rows[key]
+            changed.append({"op": "delete", "key": key})
+        if changed:
+            self.tweets.backend.append(changed)
+            self.tweets.reindex()
+        lost_follows = sorted({
+            key
+            for index in (self.followers, self.following)
+            for user_id, entries in index.groups.items() if user_id not in self.users.rows
+            for _, key in entries
+        })
+        for key in lost_follows:
+            del self.follows.rows[key]
+        if lost_follows:
+            self.follows.backend.append([{"op": "delete", "key": key} for key in lost_follows])
+            self.follows.reindex()
+        if lost_tweets or lost_follows:
+            logger.warning(
+                "Deleted %d tweets and %d follows of users that don't exist",
+                len(lost_tweets), len(lost_follows)
+            )
+
+    def finish_renames(self):
+        """
+        Moves the tweets and follows left under the old user_id of the
+        users that have RENAMED_FROM, then drops it from them
+        """
+        renamed = [(key, user) for key, user in self.users.rows.items() if RENAMED_FROM in user]
+        if not renamed:
+            return
+        tweets = []
+        follows = []
+        users = []
+        for new_id, user in renamed:
+            old_id = user[RENAMED_FROM]
+            for key in self.tweets_by_author.keys(old_id):
+                tweet = {**self.tweets.rows[key], "author_id": new_id}
+                self.tweets.rows[key] = tweet
+                tweets.append({"op": "put", "record": tweet})
+            for key in dict.fromkeys(self.followers.keys(old_id) + self.following.keys(old_id)):
+                follow = moved_follow(dict(self.follows.rows.pop(key)), old_id, new_id)
+                self.follows.rows[follow["follow_id"]] = follow
+                follows += [{"op": "delete", "key": key}, {"op": "put", "record": follow}]
+            user = {field: value for field, value in user.items() if field != RENAMED_FROM}
+            self.users.rows[new_id] = user
+            users.append({"op": "put", "record": user})
+        for table, entries in ((self.tweets, tweets), (self.follows, follows), (self.users, users)):
+            if entries:
+                table.backend.append(entries)
+                table.reindex()
+        logger.warning("Finished moving the tweets and follows of %d renamed users", len(renamed))
+
+    def join(self, tweet:Optional[dict]) -> Optional[dict]:
+        """
+        The tweet as the API shows it, with its author as "by".
+        None if the author doesn't exist anymore
+        """
+        if tweet is None or "author_id" not in tweet:
+            return tweet
+        author = self.users.get(tweet["author_id"])
+        if author is None:
+            return None
+        joined = {key: value for key, value in tweet.items() if key != "author_id"}
+        joined["by"] = public(author)
+        return joined
+
+    async def adelete_user(self, user_id:str) -> Optional[dict]:
+        """
+        Deletes a user with their tweets and follows. They are found in
+        the author and follow indexes, so only those records are touched.
+        If the process stops in between, normalize() deletes what is
+        left at the next start
+        """
+        user = await self.users.adelete(user_id)
+        if user is not None:
+            await asyncio.gather(
+                self.tweets.adelete_group(self.tweets_by_author, user_id),
+                self.follows.adelete_group(self.followers, user_id),
+                self.follows.adelete_group(self.following, user_id)
+            )
+        return user
+
+    async def areplace_user(self, user_id:str, record:dict) -> Optional[dict]:
+        """
+        Replaces a user. Tweets show the current author through join(),
+        so they only change if the user_id does: then the tweets and
+        follows of the user are moved to the new one.
+
+        The user is written first with the old user_id in RENAMED_FROM,
+        and without it once the move is done. If the move fails or the
+        process stops in between, normalize() finishes it at the next
+        start
+        """
+        new_id = record["user_id"]
+        if new_id == user_id:
+            return await self.users.areplace(user_id, record)
+        user = await self.users.areplace(user_id, {**record, RENAMED_FROM: user_id})
+        if user is not None:
+            await asyncio.gather(
+                self.tweets.areplace_group(
+                    self.tweets_by_author, user_id, lambda tweet: {**tweet, "author_id": new_id}
+                ),
+                self.follows.areplace_group(
+                    self.followers, user_id, lambda follow: moved_follow(follow, user_id, new_id)
+                ),
+                self.follows.areplace_group(
+                    self.following, user_id, lambda follow: moved_follow(follow, user_id, new_id)
+                )
+            )
+            user = await self.users.areplace(new_id, record)
+        return user
+
+    async def aload(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(io_executor, self.load)
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(io_executor, self.close)
+
+    def close(self):
+        if self.compactor is not None:
+            self.compactor.stop()
+            self.compactor = None
+        if self.writer is not None:
+            for table in self.tables:
+                table.writer = None
+            self.writer.stop()
+            self.writer = None
+        for table in self.tables:
+            table.close()
@@ -0,0 +1,6 @@
+# Python
+import os
+import sys
+
+# The app modules sit flat in twitter-api/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
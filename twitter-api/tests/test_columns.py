@@ -0,0 +1,60 @@
+# Python
+import sys
+import threading
+# Columns
+from columns import ColumnarRows
+from storage import TWEET_COLUMNS
+
+def tweet(key:str, version:int) -> dict:
+    return {
+        "tweet_id": key,
+        "content": f"{key}-{version}",
+        "created_at": "2022-01-01 10:00:00",
+        "updated_at": None,
+        "author_id": f"a{version}"
+    }
+
+def test_read_records_while_the_writer_rewrites_them():
+    interval = sys.getswitchinterval()
+    # Switch threads as often as possible, so the race shows up
+    sys.setswitchinterval(1e-6)
+    rows = ColumnarRows("tweet_id", TWEET_COLUMNS)
+    keys = [f"k{i}" for i in range(8)]
+    for key in keys:
+        rows[key] = tweet(key, 0)
+    stop = threading.Event()
+    errors = []
+
+    def writer():
+        version = 0
+        while not stop.is_set():
+            version += 1
+            for key in keys:
+                rows[key] = tweet(key, version)
+
+    def reader(start:int):
+        for i in range(3000):
+            key = keys[(start + i) % len(keys)]
+            try:
+                record = dict(rows[key])
+            except Exception as error:
+                errors.append(repr(error))
+                continue
+            # Every field of one version, never a mix
+            version = record["content"].split("-")[1]
+            if record != tweet(key, int(version)):
+                errors.append(record)
+
+    threads = [threading.Thread(target=reader, args=(start,)) for start in range(4)]
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for reading in threads:
+            reading.start()
+        for reading in threads:
+            reading.join()
+    finally:
+        stop.set()
+        thread.join()
+        sys.setswitchinterval(interval)
+    assert errors == []
@@ -0,0 +1,53 @@
+# Python
+import json
+import time
+import base64
+from datetime import datetime,timedelta,timezone
+# Testing
+import pytest
+# Storage
+from storage import decode_cursor,encode_cursor,timestamp
+
+def test_timestamps_dont_depend_on_the_local_time_zone(monkeypatch):
+    keys = []
+    for zone in ("UTC", "America/Bogota", "Asia/Tokyo"):
+        monkeypatch.setenv("TZ", zone)
+        time.tzset()
+        keys.append(timestamp("2024-03-10 12:30:00.250000"))
+    monkeypatch.undo()
+    time.tzset()
+    assert len(set(keys)) == 1
+    assert keys[0] == datetime(2024, 3, 10, 12, 30, 0, 250000, tzinfo=timezone.utc).timestamp()
+    # Values with a time zone keep theirs
+    bogota = timezone(timedelta(hours=-5))
+    assert timestamp("2024-03-10 07:30:00.250000-05:00") == keys[0]
+    assert timestamp(datetime(2024, 3, 10, 7, 30, 0, 250000, tzinfo=bogota)) == keys[0]
+
+def cursor(entry) -> str:
+    return base64.urlsafe_b64encode(json.dumps(entry).encode()).decode()
+
+def test_cursors_round_trip():
+    assert decode_cursor(encode_cursor((1.5, "a"))) == (1.5, "a")
+    assert decode_cursor(encode_cursor((3, "a"))) == (3, "a")
+    # users_by_id sorts by the key itself
+    assert decode_cursor(encode_cursor(("b", "b")), str) == ("b", "b")
+
+@pytest.mark.parametrize("value", [
+    "%%%",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    cursor({"value": 1, "key": "a"}),
+    cursor([1.5]),
+    cursor([1.5, "a", "b"]),
+    cursor([True, "a"]),
+    cursor(["2024-01-01", "a"]),
+    cursor([None, "a"]),
+    cursor([1.5, 2]),
+    cursor([1.5, None])
+])
+def test_invalid_cursors_are_rejected(value):
+    with pytest.raises(ValueError):
+        decode_cursor(value)
+
+def test_cursors_of_another_index_are_rejected():
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor((1.5, "a")), str)
@@ -0,0 +1,136 @@
+# Python
+import asyncio
+# Storage
+from storage import RENAMED_FROM,Repository,follow_id
+
+def user(user_id:str) -> dict:
+    return {
+        "user_id": user_id,
+        "email": f"{user_id}@example.com",
+        "password": "x",
+        "first_name": "A",
+        "last_name": "B",
+        "birth_date": None
+    }
+
+def repository(directory) -> Repository:
+    repository = Repository(
+        str(directory / "user.json"),
+        str(directory / "tweets.json"),
+        str(directory / "follows.json")
+    )
+    repository.load()
+    return repository
+
+def test_an_interrupted_rename_is_finished_at_the_next_start(tmp_path, monkeypatch):
+    r = repository(tmp_path)
+    for user_id in ("a", "b"):
+        r.users.insert(user(user_id))
+    r.tweets.insert({
+        "tweet_id": "t", "content": "hola", "created_at": "2024-01-01 00:00:00",
+        "updated_at": None, "author_id": "a"
+    })
+    r.follows.insert({"follow_id": follow_id("b", "a"), "follower_id": "b", "followee_id": "a"})
+
+    async def fail(*args):
+        raise OSError("stopped")
+    # The user is written, moving what is theirs fails
+    monkeypatch.setattr(r.follows, "areplace_group", fail)
+    try:
+        asyncio.run(r.areplace_user("a", user("c")))
+    except OSError:
+        pass
+    assert RENAMED_FROM in r.users.get("c")
+    r.close()
+
+    r = repository(tmp_path)
+    try:
+        assert r.tweets.get("t")["author_id"] == "c"
+        assert list(r.follows.rows) == [follow_id("b", "c")]
+        assert RENAMED_FROM not in r.users.get("c")
+        assert r.users.get("a") is None
+    finally:
+        r.close()
+
+def test_a_rename_moves_tweets_and_follows(tmp_path):
+    r = repository(tmp_path)
+    try:
+        for user_id in ("a", "b"):
+            r.users.insert(user(user_id))
+        r.follows.insert({"follow_id": follow_id("a", "b"), "follower_id": "a", "followee_id": "b"})
+        renamed = asyncio.run(r.areplace_user("a", user("c")))
+        assert renamed["user_id"] == "c" and RENAMED_FROM not in renamed
+        assert r.following.keys("c") == [follow_id("c", "b")]
+    finally:
+        r.close()
+
+def test_a_failed_compaction_keeps_the_rotated_log(tmp_path, monkeypatch):
+    r = repository(tmp_path)
+    backend = r.users.backend
+    r.users.insert(user("a"))
+
+    def fail(*args):
+        raise OSError("no space left")
+    monkeypatch.setattr(backend, "write_snapshot", fail)
+    try:
+        r.users.compact()
+    except OSError:
+        pass
+    # Still pending, and rotating again doesn't replace the first .old
+    assert backend.pending == 1
+    r.users.insert(user("b"))
+    try:
+        r.users.compact()
+    except OSError:
+        pass
+    assert backend.pending == 2
+    # Stopped before a compaction succeeds
+    monkeypatch.setattr(r.users, "compact", lambda: None)
+    r.close()
+
+    r = repository(tmp_path)
+    try:
+        assert r.users.get("a") is not None and r.users.get("b") is not None
+    finally:
+        r.close()
+
+def test_a_failed_append_rolls_the_writes_back(tmp_path, monkeypatch):
+    r = repository(tmp_path)
+    try:
+        for user_id in ("a", "b"):
+            r.users.insert(user(user_id))
+        rows = {key: dict(record) for key, record in r.users.rows.items()}
+        entries = list(r.users_by_id.entries)
+
+        def fail(entries):
+            raise OSError("no space left")
+        monkeypatch.setattr(r.users.backend, "append", fail)
+        changed = dict(user("a"), email="new@example.com")
+        for write in (
+            lambda: r.users.insert(user("c")),
+            lambda: r.users.replace("a", changed),
+            lambda: r.users.delete("b")
+        ):
+            try:
+                write()
+            except OSError:
+                pass
+            else:
+                raise AssertionError("the write didn't fail")
+        # Neither the rows nor the indexes keep the writes
+        assert {key: dict(record) for key, record in r.users.rows.items()} == rows
+        assert r.users_by_id.entries == entries
+        assert r.users_by_email.get("a@example.com") == "a"
+        assert r.users_by_email.get("new@example.com") is None
+
+        monkeypatch.undo()
+        r.users.replace("a", changed)
+        assert r.users_by_email.get("new@example.com") == "a"
+    finally:
+        r.close()
+    r = repository(tmp_path)
+    try:
+        assert sorted(r.users.rows) == ["a", "b"]
+        assert r.users.get("a")["email"] == "new@example.com"
+    finally:
+        r.close()
@@ -0,0 +1,31 @@
+# Python
+import sys
+import threading
+# Search
+from search import SearchIndex
+
+def test_search_while_the_writer_changes_the_postings():
+    interval = sys.getswitchinterval()
+    # Switch threads as often as possible, so the race shows up
+    sys.setswitchinterval(1e-6)
+    index = SearchIndex(lambda tweet: tweet["content"])
+    index.rebuild({str(i): {"content": "hola mundo"} for i in range(500)})
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            key = str(i % 500)
+            index.add(key, {"content": "adios" if i % 1000 < 500 else "hola mundo"})
+            i += 1
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for _ in range(300):
+            keys, _ = index.search("hola mundo", 50)
+            assert len(keys) <= 50
+    finally:
+        stop.set()
+        thread.join()
+        sys.setswitchinterval(interval)
@@ -0,0 +1,53 @@
+# Storage
+from backends import JSONBackend,SQLiteBackend
+from storage import Table
+
+def tweet(tweet_id:str, content:str = "hola") -> dict:
+    return {"tweet_id": tweet_id, "content": content}
+
+def sqlite_table(path) -> Table:
+    table = Table(SQLiteBackend(str(path), "tweets", "tweet_id"), "tweet_id")
+    table.load()
+    return table
+
+def test_workers_sharing_sqlite_give_the_same_data_the_same_version(tmp_path):
+    path = tmp_path / "twitter.db"
+    first, second = sqlite_table(path), sqlite_table(path)
+    try:
+        assert first.version()[:2] == second.version()[:2]
+        first.insert(tweet("a"))
+        first.insert(tweet("b"))
+        assert first.version()[:2] != second.version()[:2]
+        second.sync()
+        assert first.version()[:2] == second.version()[:2]
+        assert first.version("a")[:2] == second.version("a")[:2]
+        second.update("a", {"content": "adios"})
+        first.sync()
+        assert first.version()[:2] == second.version()[:2]
+        # A worker started later agrees too
+        third = sqlite_table(path)
+        assert third.version()[:2] == first.version()[:2]
+        third.close()
+    finally:
+        first.close()
+        second.close()
+
+def test_a_new_database_starts_another_epoch(tmp_path):
+    first = sqlite_table(tmp_path / "first.db")
+    second = sqlite_table(tmp_path / "second.db")
+    try:
+        assert first.version()[0] != second.version()[0]
+    finally:
+        first.close()
+        second.close()
+
+def test_versions_of_one_process_change_on_every_write(tmp_path):
+    table = Table(JSONBackend(str(tmp_path / "tweets.json"), "tweet_id"), "tweet_id")
+    table.load()
+    try:
+        before = table.version()
+        table.insert(tweet("a"))
+        assert table.version()[1] > before[1]
+        assert table.version("a")[1] == table.version()[1]
+    finally:
+        table.close()